@@ -1,9 +1,38 @@
 import sys
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
 import re
 import markdown
+import numpy as np
 import base64
+import csv
+import difflib
+import gzip
+import json
+import io
+import multiprocessing
+import hashlib
+import math
+import pickle
+import queue
+import random
+import sqlite3
+import subprocess
+import threading
+import tempfile
+import time
+import traceback
+import zlib
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 from pdf2image import convert_from_path
 import os
 from dotenv import load_dotenv
@@ -17,15 +46,18 @@ from PyQt5.QtWidgets import (
     QLayout, QGridLayout, QMainWindow, QTabWidget, QToolButton
 )
 from PyQt5.QtCore import (
-    Qt, pyqtSignal, QObject, QThread, QTimer, QRegExp, QEvent, QSize, QRect, QPoint
+    Qt, pyqtSignal, QObject, QRunnable, QThreadPool, QTimer, QRegExp, QEvent, QSize, QRect, QPoint,
+    QBuffer, QByteArray, QUrl, QCoreApplication
 )
 from PyQt5.QtGui import (
-    QFont, QPixmap, QIcon, QTransform, QTextCharFormat, QKeySequence, QTextCursor, QContextMenuEvent
+    QFont, QPixmap, QImage, QIcon, QTransform, QTextCharFormat, QKeySequence, QTextCursor, QContextMenuEvent
 )
+import httpx
+import openai
 from openai import OpenAI
 import anthropic
 from bs4 import BeautifulSoup
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
 
 ###############################################################################
 def resource_path(relative_path):
@@ -37,7 +69,2089 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 ###############################################################################
+# Query expansion post-processing
+
+# Upper bound on related queries (=> Bing calls) per search, by model tier
+MAX_RELATED_QUERIES = {
+    'gpt-4o-mini': 3,
+    'claude-3-5-haiku-latest': 3,
+    'o1-mini': 2,
+    'gpt-4o': 4,
+    'claude-3-5-sonnet-latest': 4,
+    'o1-preview': 5
+}
+DEFAULT_MAX_RELATED_QUERIES = 3
+
+# Queries whose token sets overlap at least this much are merged
+QUERY_SIMILARITY_THRESHOLD = 0.75
+
+STOPWORDS = frozenset("""
+    a an and are as at be by for from how i in is it of on or that the this
+    to was what when where which who why with vs versus about into
+""".split())
+
+PREAMBLE_RE = re.compile(
+    r"^(here (are|is)|sure|certainly|of course|below|these|i hope|let me|note\b|"
+    r"related (search )?queries|search queries)",
+    re.IGNORECASE
+)
+LIST_MARKER_RE = re.compile(r"^\s*(?:[-*•]+|\(?\d+[.):]|[a-z][.)])\s+", re.IGNORECASE)
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def token_set(text):
+    tokens = set(tokenize(text))
+    content = tokens - STOPWORDS
+    return content or tokens
+
+
+def token_set_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def clean_query_line(line):
+    line = LIST_MARKER_RE.sub('', line.strip())
+    line = line.replace('**', '').replace('__', '')
+    return line.strip().strip('"\'`').strip()
+
+
+def is_query_line(line):
+    if not line or not re.search(r"[A-Za-z0-9]", line):
+        return False
+    if line.endswith(':') or PREAMBLE_RE.match(line):
+        return False
+    return len(line) <= 200 and len(line.split()) <= 25
+
+
+def process_related_queries(query, lines, max_queries):
+    """ Turn raw model output into a capped, deduplicated, ranked query list """
+    query_tokens = token_set(query)
+    kept = []
+    for raw in lines:
+        candidate = clean_query_line(raw)
+        if not is_query_line(candidate):
+            continue
+        tokens = token_set(candidate)
+        if any(token_set_similarity(tokens, t) >= QUERY_SIMILARITY_THRESHOLD for _, t in kept):
+            continue
+        kept.append((candidate, tokens))
+
+    def relevance(item):
+        tokens = item[1]
+        coverage = len(tokens & query_tokens) / len(query_tokens) if query_tokens else 0.0
+        return 0.7 * coverage + 0.3 * token_set_similarity(tokens, query_tokens)
+
+    # sorted() is stable, so ties keep the model's own ordering
+    ranked = sorted(kept, key=relevance, reverse=True)
+    queries = [text for text, _ in ranked[:max_queries]]
+    return queries or [query]
+
+###############################################################################
+# Result deduplication
+
+TRACKING_PARAMS = frozenset([
+    'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid',
+    '_hsenc', '_hsmi', 'ref', 'ref_src', 'spm', 'cmpid', 'ocid', 'sr_share'
+])
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+INDEX_PAGE_RE = re.compile(r"/(index|default)\.(html?|php|aspx?)$", re.IGNORECASE)
+MIRROR_HOST_PREFIXES = ('www.', 'm.', 'amp.', 'mobile.')
+
+SIMHASH_MIN_TOKENS = 6
+SIMHASH_BANDS = 4
+SIMHASH_BAND_BITS = 64 // SIMHASH_BANDS
+
+# Thumbnails whose 64-bit dHash differs in at most this many bits are one photo
+DHASH_MAX_DISTANCE = 6
+DHASH_BANDS = 8
+DHASH_BAND_BITS = 64 // DHASH_BANDS
+
+
+def canonicalize_url(url):
+    """ Normalize a URL so trivially different links to one page compare equal """
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https', ''):
+        return url.strip()
+
+    host = (parts.hostname or '').rstrip('.')
+    for prefix in MIRROR_HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+
+    path = re.sub(r"/{2,}", "/", parts.path)
+    path = INDEX_PAGE_RE.sub('', path).rstrip('/')
+
+    params = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith('utm_') and k.lower() not in TRACKING_PARAMS
+    ]
+    # http vs https is not a different source, so the scheme is dropped entirely
+    return urlunsplit(('', host, path, urlencode(sorted(params)), '')).lstrip('/')
+
+
+def hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def simhash(text):
+    """ 64-bit SimHash over word unigrams and bigrams """
+    words = tokenize(re.sub(r"<[^>]+>", " ", text))
+    if len(words) < SIMHASH_MIN_TOKENS:
+        return None
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    weights = [0] * 64
+    for feature in features:
+        h = hash64(feature)
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class ResultDeduper:
+    """ Bounded set of seen sources: canonical URL hashes plus SimHash fingerprints """
+
+    def __init__(self, max_entries=4096, max_distance=3):
+        # max_distance < SIMHASH_BANDS guarantees a near-duplicate shares at least one band
+        self.max_entries = max_entries
+        self.max_distance = min(max_distance, SIMHASH_BANDS - 1)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.url_keys = set()
+            self.bands = [dict() for _ in range(SIMHASH_BANDS)]
+            self.order = deque()
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, url):
+        return hash64(canonicalize_url(url)) in self.url_keys
+
+    def bandKeys(self, fingerprint):
+        mask = (1 << SIMHASH_BAND_BITS) - 1
+        return [(fingerprint >> (i * SIMHASH_BAND_BITS)) & mask for i in range(SIMHASH_BANDS)]
+
+    def isNearDuplicate(self, fingerprint):
+        for band, key in zip(self.bands, self.bandKeys(fingerprint)):
+            for other in band.get(key, ()):
+                if bin(fingerprint ^ other).count('1') <= self.max_distance:
+                    return True
+        return False
+
+    def seen(self, url, text=''):
+        """ Return True if this source was already seen, otherwise record it """
+        url_key = hash64(canonicalize_url(url))
+        fingerprint = simhash(text) if text else None
+        with self.lock:
+            if url_key in self.url_keys:
+                return True
+            if fingerprint is not None and self.isNearDuplicate(fingerprint):
+                return True
+            self.url_keys.add(url_key)
+            if fingerprint is not None:
+                for band, key in zip(self.bands, self.bandKeys(fingerprint)):
+                    band.setdefault(key, []).append(fingerprint)
+            self.order.append((url_key, fingerprint))
+            while len(self.order) > self.max_entries:
+                self.evictOldest()
+            return False
+
+    def evictOldest(self):
+        url_key, fingerprint = self.order.popleft()
+        self.url_keys.discard(url_key)
+        if fingerprint is None:
+            return
+        for band, key in zip(self.bands, self.bandKeys(fingerprint)):
+            bucket = band.get(key)
+            if bucket:
+                bucket.remove(fingerprint)
+                if not bucket:
+                    del band[key]
+
+
+class ImageHashIndex:
+    """ dHash fingerprints of the thumbnails a tab has shown, banded for Hamming-distance lookup """
+
+    def __init__(self, max_distance=DHASH_MAX_DISTANCE):
+        # As with SimHash, max_distance < DHASH_BANDS means a near match shares a band
+        self.max_distance = min(max_distance, DHASH_BANDS - 1)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.bands = [dict() for _ in range(DHASH_BANDS)]
+            self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def bandKeys(self, fingerprint):
+        mask = (1 << DHASH_BAND_BITS) - 1
+        return [(fingerprint >> (i * DHASH_BAND_BITS)) & mask for i in range(DHASH_BANDS)]
+
+    def seen(self, fingerprint):
+        """ Return True if a lookalike was already shown, otherwise record this one """
+        keys = self.bandKeys(fingerprint)
+        with self.lock:
+            for band, key in zip(self.bands, keys):
+                for other in band.get(key, ()):
+                    if bin(fingerprint ^ other).count('1') <= self.max_distance:
+                        return True
+            for band, key in zip(self.bands, keys):
+                band.setdefault(key, []).append(fingerprint)
+            self.count += 1
+            return False
+
+###############################################################################
+# Rate limiting and retries
+
+def env_float(name, default):
+    try:
+        return float(os.getenv(name, '') or default)
+    except ValueError:
+        return default
+
+
+def env_int(name, default):
+    return int(env_float(name, default))
+
+
+def env_flag(name, default=False):
+    value = os.getenv(name, '').strip().lower()
+    if not value:
+        return default
+    return value in ('1', 'true', 'yes', 'on')
+
+
+class TokenBucket:
+    """ Thread-safe token bucket; refills at `rate` tokens per second up to `capacity` """
+
+    def __init__(self, rate, capacity):
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def tryAcquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if now >= self.blocked_until and self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                else:
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # The provider told us to back off: hold every caller, not just the one that got the 429
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+# Process-wide, shared by all tabs. Rates come from our quota (requests per second).
+RATE_LIMITERS = {
+    'bing': TokenBucket(env_float('BING_QPS', 3), env_float('BING_BURST', 3)),
+    'openai': TokenBucket(env_float('OPENAI_RPM', 500) / 60, env_float('OPENAI_BURST', 10)),
+    'anthropic': TokenBucket(env_float('ANTHROPIC_RPM', 50) / 60, env_float('ANTHROPIC_BURST', 5))
+}
+
+# At least one attempt, or call_with_retry would return None without calling
+RETRY_ATTEMPTS = max(1, env_int('RETRY_ATTEMPTS', 4))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+HTTP_TIMEOUT = 15
+
+
+def error_status(exc):
+    response = getattr(exc, 'response', None)
+    return getattr(response, 'status_code', None) or getattr(exc, 'status_code', None)
+
+
+def retry_after_seconds(exc):
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc):
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, (openai.APIConnectionError, anthropic.APIConnectionError)):
+        return True
+    return error_status(exc) in RETRYABLE_STATUS
+
+
+def call_with_retry(provider, fn, *args, **kwargs):
+    """ Call fn under the provider's rate limit, retrying transient failures with jittered backoff """
+    limiter = RATE_LIMITERS[provider]
+    for attempt in range(RETRY_ATTEMPTS):
+        limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            server_delay = retry_after_seconds(e)
+            if server_delay is not None:
+                delay = min(server_delay, RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY)
+                limiter.pause(delay)
+            else:
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt + 1)))
+            print(f"[DEBUG] {provider} call failed ({e}); retry {attempt + 1} in {delay:.1f}s.")
+            time.sleep(delay)
+
+###############################################################################
+# HTTP record/replay. With ALVELY_HTTP_MODE=record every outbound request (Bing,
+# model APIs, thumbnails, favicons) is saved to the ALVELY_CASSETTE file; with
+# replay they are served from it offline, at the recorded pace times
+# ALVELY_REPLAY_SCALE (0 = no waiting).
+
+HTTP_MODE = os.getenv('ALVELY_HTTP_MODE', 'live').strip().lower()
+CASSETTE_PATH = os.getenv('ALVELY_CASSETTE') or 'alvely-cassette.jsonl.gz'
+REPLAY_SCALE = env_float('ALVELY_REPLAY_SCALE', 1.0)
+# Credentials never reach the cassette, and don't take part in matching
+SECRET_PARAMS = {'key', 'api_key', 'apikey', 'api-key', 'subscription-key', 'token', 'access_token'}
+# requests hands back decoded bodies, so these no longer describe what is stored
+BODY_ENCODING_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+
+
+def cassette_url(url):
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in SECRET_PARAMS]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+
+class Cassette:
+    """
+    Recorded exchanges, one JSON object per line (gzip when the name ends in
+    .gz, each line its own gzip member so a killed recorder leaves a readable
+    file). Requests match on method, URL and a hash of the body; repeats of the
+    same request are replayed in recorded order, the last one reused after that.
+    """
+
+    def __init__(self, path, mode, scale):
+        self.path = path
+        self.mode = mode
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.out = None
+        if mode == 'replay':
+            self.load()
+
+    @staticmethod
+    def key(method, url, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        return f"{method.upper()} {cassette_url(url)} {hashlib.sha256(body or b'').hexdigest()[:16]}"
+
+    def open(self, mode):
+        opener = gzip.open if self.path.endswith('.gz') else open
+        return opener(self.path, mode + 't', encoding='utf-8')
+
+    def load(self):
+        with self.open('r') as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(entry['key'], deque()).append(entry)
+            except (EOFError, gzip.BadGzipFile, zlib.error, json.JSONDecodeError) as e:
+                # The recorder died mid-write; everything before the torn entry is intact
+                print(f"[DEBUG] Cassette ends in a truncated entry ({e}); ignoring it.")
+        print(f"[DEBUG] Replaying {sum(map(len, self.entries.values()))} recorded HTTP exchanges.")
+
+    def take(self, key):
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                return None
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def record(self, key, status, headers, wait, chunks):
+        entry = {
+            'key': key,
+            'status': status,
+            'headers': headers,
+            'wait': round(wait, 4),
+            'chunks': [[round(offset, 4), base64.b64encode(data).decode('ascii')] for offset, data in chunks]
+        }
+        data = (json.dumps(entry) + "\n").encode('utf-8')
+        if self.path.endswith('.gz'):
+            data = gzip.compress(data)
+        with self.lock:
+            if self.out is None:
+                self.out = open(self.path, 'wb')
+            self.out.write(data)
+            self.out.flush()
+
+    def sleep(self, seconds):
+        if seconds > 0 and self.scale > 0:
+            time.sleep(seconds * self.scale)
+
+    def chunks(self, entry):
+        # Yields the body as recorded, each chunk at its original offset (scaled)
+        started = time.monotonic()
+        for offset, data in entry['chunks']:
+            self.sleep(offset - (time.monotonic() - started) / (self.scale or 1))
+            yield base64.b64decode(data)
+
+
+class CassetteAdapter(HTTPAdapter):
+    """ requests transport for the shared session """
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        key = Cassette.key(request.method, request.url, request.body)
+        if self.cassette.mode == 'replay':
+            entry = self.cassette.take(key)
+            if entry is None:
+                raise requests.ConnectionError(f"No recorded response for {key}", request=request)
+            self.cassette.sleep(entry['wait'])
+            raw = HTTPResponse(
+                body=io.BytesIO(b''.join(self.cassette.chunks(entry))),
+                headers=entry['headers'],
+                status=entry['status'],
+                preload_content=False
+            )
+            return self.build_response(request, raw)
+
+        started = time.monotonic()
+        resp = super().send(request, **kwargs)
+        wait = time.monotonic() - started
+        body = resp.content
+        headers = [[k, v] for k, v in resp.headers.items() if k.lower() not in BODY_ENCODING_HEADERS]
+        self.cassette.record(key, resp.status_code, headers, wait, [(time.monotonic() - started - wait, body)])
+        return resp
+
+
+class RecordingStream(httpx.SyncByteStream):
+    def __init__(self, cassette, key, response, started):
+        self.cassette = cassette
+        self.key = key
+        self.response = response
+        self.started = started
+        self.wait = time.monotonic() - started
+        self.received = []
+
+    def __iter__(self):
+        for data in self.response.stream:
+            self.received.append((time.monotonic() - self.started - self.wait, data))
+            yield data
+
+    def close(self):
+        # Also reached when a caller stops reading early; what arrived so far is kept
+        self.response.close()
+        if self.received is not None:
+            headers = [[k.decode('latin-1'), v.decode('latin-1')] for k, v in self.response.headers.raw]
+            self.cassette.record(self.key, self.response.status_code, headers, self.wait, self.received)
+            self.received = None
+
+
+class ReplayStream(httpx.SyncByteStream):
+    def __init__(self, cassette, entry):
+        self.cassette = cassette
+        self.entry = entry
+
+    def __iter__(self):
+        return self.cassette.chunks(self.entry)
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """ httpx transport for the OpenAI/Anthropic clients; bodies are stored exactly as sent on the wire """
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self.inner = httpx.HTTPTransport() if cassette.mode == 'record' else None
+
+    def handle_request(self, request):
+        key = Cassette.key(request.method, str(request.url), request.read())
+        if self.cassette.mode == 'replay':
+            entry = self.cassette.take(key)
+            if entry is None:
+                raise httpx.ConnectError(f"No recorded response for {key}", request=request)
+            self.cassette.sleep(entry['wait'])
+            return httpx.Response(
+                entry['status'], headers=entry['headers'], stream=ReplayStream(self.cassette, entry), request=request
+            )
+        started = time.monotonic()
+        response = self.inner.handle_request(request)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=RecordingStream(self.cassette, key, response, started),
+            request=request,
+            extensions=response.extensions
+        )
+
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+
+
+CASSETTE = Cassette(CASSETTE_PATH, HTTP_MODE, REPLAY_SCALE) if HTTP_MODE in ('record', 'replay') else None
+
+# Shared session: keeps connections alive across requests and is where the cassette plugs in
+HTTP = requests.Session()
+if CASSETTE is not None:
+    HTTP.mount('http://', CassetteAdapter(CASSETTE))
+    HTTP.mount('https://', CassetteAdapter(CASSETTE))
+
+
+def sdk_http_client(sdk):
+    # None lets the SDK build its usual client
+    if CASSETTE is None:
+        return None
+    return sdk.DefaultHttpxClient(transport=CassetteTransport(CASSETTE))
+
+###############################################################################
+# Shared caches (used by the real pipeline and by speculative prefetch)
+
+class TTLCache:
+    """ Small thread-safe LRU cache whose entries expire after `ttl` seconds """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class SingleFlight:
+    """ Concurrent calls with the same key share one execution; every caller gets its result or error """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, cancel_event=None):
+        # Returns (result, shared); shared is True when another caller did the work
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = Future()
+            if leader:
+                try:
+                    result = fn()
+                except BaseException as e:
+                    call.set_exception(e)
+                    raise
+                else:
+                    call.set_result(result)
+                    return result, False
+                finally:
+                    with self.lock:
+                        del self.calls[key]
+            try:
+                return self.wait(call, cancel_event), True
+            except Cancelled:
+                # The leader's own caller gave up; ours still wants the result, so try again
+                if cancel_event is not None and cancel_event.is_set():
+                    raise
+
+    def wait(self, call, cancel_event):
+        # Waiting callers can still be cancelled on their own
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise Cancelled()
+            try:
+                return call.result(timeout=0.1)
+            except FutureTimeout:
+                pass
+
+
+def normalize_query(query):
+    # Case and whitespace only: punctuation can matter ("C++" vs "C#" vs "C")
+    return ' '.join(query.lower().split())
+
+
+# (model_id, normalized query) => expanded query list
+EXPANSION_CACHE = TTLCache(max_size=256, ttl=30 * 60)
+# (endpoint, normalized params) => Bing JSON response
+SEARCH_CACHE = TTLCache(max_size=1024, ttl=10 * 60)
+# Bing requests and expansion prompts in flight across all tabs, keyed like the caches above
+IN_FLIGHT = SingleFlight()
+
+SPECULATIVE_DEFAULT = env_flag('ALVELY_SPECULATIVE')
+SPECULATION_DELAY_MS = env_int('SPECULATION_DELAY_MS', 600)
+SPECULATION_MIN_CHARS = 4
+# Caps calls spent on speculation that may never be used: 30 calls, refilled over 5 minutes
+SPECULATION_BUDGET = TokenBucket(30 / 300, 30)
+
+
+class Cancelled(Exception):
+    pass
+
+
+###############################################################################
+# "More" pagination
+
+LINKS_PER_PAGE = 2
+IMAGES_PER_PAGE = 10
+# Image pages fetched ahead of the one being shown, per expanded query
+IMAGE_PREFETCH_PAGES = 1
+# How many already-seen pages "More" skips through before giving up on a query
+MAX_PAGE_SKIPS = 3
+
+
+class PagingState:
+    """ Per-tab Bing offset cursors for one typed query; replaced, not mutated, when the query changes """
+
+    def __init__(self, query=None):
+        self.query = query
+        # Expanded query set, kept so image "More" needs no model call
+        self.related = []
+        self.offsets = {}
+        self.exhausted = set()
+        self.lock = threading.Lock()
+
+    def offset(self, q):
+        with self.lock:
+            return self.offsets.get(normalize_query(q), 0)
+
+    def advance(self, q, next_offset, exhausted=False):
+        key = normalize_query(q)
+        with self.lock:
+            self.offsets[key] = max(self.offsets.get(key, 0), next_offset)
+            if exhausted:
+                self.exhausted.add(key)
+
+    def isExhausted(self, q):
+        with self.lock:
+            return normalize_query(q) in self.exhausted
+
+###############################################################################
+# Hedged model requests
+
+class LatencyTracker:
+    """ Rolling window of recent latencies per key, e.g. (model_id, 'stream') """
+
+    def __init__(self, window=50, min_samples=5):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key, pct, default):
+        with self.lock:
+            values = sorted(self.samples.get(key, ()))
+        if len(values) < self.min_samples:
+            return default
+        index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+        return values[index]
+
+
+MODEL_LATENCY = LatencyTracker()
+
+# Off by default: hedging can double model spend on slow requests
+HEDGE_ENABLED = env_flag('ALVELY_HEDGE')
+HEDGE_PERCENTILE = env_float('HEDGE_PERCENTILE', 90)
+# Used until a model has enough latency samples
+HEDGE_DEFAULT_DELAY = env_float('HEDGE_DEFAULT_DELAY', 3.0)
+# Backup model per latency-sensitive tier ("Fast" and "Faster")
+HEDGE_BACKUPS = {
+    'gpt-4o-mini': os.getenv('HEDGE_BACKUP_GPT_4O_MINI') or 'claude-3-5-haiku-latest',
+    'claude-3-5-haiku-latest': os.getenv('HEDGE_BACKUP_CLAUDE_3_5_HAIKU') or 'gpt-4o-mini'
+}
+MODEL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='model')
+
+
+class HedgedRace:
+    """ Runs delta generators for several models; the first to produce output wins """
+
+    def __init__(self):
+        self.outcomes = queue.Queue()
+        self.lock = threading.Lock()
+        self.decided = False
+
+    def start(self, model_id, make_deltas, latency_key):
+        MODEL_EXECUTOR.submit(self.contend, model_id, make_deltas, latency_key)
+
+    def contend(self, model_id, make_deltas, latency_key):
+        started = time.monotonic()
+        deltas = make_deltas()
+        try:
+            first = next(deltas, '')
+        except Exception as e:
+            self.outcomes.put((model_id, None, None, e))
+            return
+        MODEL_LATENCY.record(latency_key(model_id), time.monotonic() - started)
+        with self.lock:
+            if self.decided:
+                # Lost the race: drop the response and close its connection
+                deltas.close()
+                return
+            self.outcomes.put((model_id, first, deltas, None))
+
+    def next(self, timeout=None):
+        return self.outcomes.get(timeout=timeout)
+
+    def finish(self):
+        with self.lock:
+            self.decided = True
+        while True:
+            try:
+                _, _, deltas, _ = self.outcomes.get_nowait()
+            except queue.Empty:
+                return
+            if deltas is not None:
+                deltas.close()
+
+###############################################################################
+# Anthropic Messages API
+
+ANTHROPIC_MAX_TOKENS = 1024
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def image_media_type(data_b64):
+    head = base64.b64decode(data_b64[:24] + '=' * (-len(data_b64[:24]) % 4), validate=False)
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if head.startswith(b'GIF8'):
+        return 'image/gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/png'
+
+
+def anthropic_blocks(content):
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}] if content else []
+    blocks = []
+    for part in content:
+        if part.get('type') == 'image_url':
+            data = part['image_url']['url'].split(',', 1)[-1]
+            blocks.append({
+                "type": "image",
+                "source": {"type": "base64", "media_type": image_media_type(data), "data": data}
+            })
+        elif part.get('text'):
+            blocks.append({"type": "text", "text": part['text']})
+    return blocks
+
+
+def to_anthropic_request(messages):
+    """ Convert chat-completions messages to Messages API (system, messages), marking the stable prefix cacheable """
+    system = []
+    turns = []
+    for msg in messages:
+        blocks = anthropic_blocks(msg['content'])
+        if msg['role'] == 'system':
+            system.extend(blocks)
+        elif turns and turns[-1]['role'] == msg['role']:
+            # The API wants alternating roles; the history's last question and the prompt are merged
+            turns[-1]['content'].extend(blocks)
+        elif blocks:
+            turns.append({"role": msg['role'], "content": blocks})
+
+    # Cache breakpoints: system prompt, earlier turns, and everything in the last turn before
+    # the per-request instruction (the typed question and attachments)
+    if system:
+        system[-1]['cache_control'] = CACHE_CONTROL
+    if len(turns) > 1:
+        turns[-2]['content'][-1]['cache_control'] = CACHE_CONTROL
+    if turns and len(turns[-1]['content']) > 1:
+        turns[-1]['content'][-2]['cache_control'] = CACHE_CONTROL
+    return system, turns
+
+
+def log_anthropic_cache(usage):
+    read = getattr(usage, 'cache_read_input_tokens', None) or 0
+    written = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    if read or written:
+        print(f"[DEBUG] Anthropic prompt cache: {read} tokens read, {written} written.")
+
+###############################################################################
+# On-disk cache for fetched binary assets (thumbnails, favicons)
+
+ASSET_CACHE_DIR = os.getenv('ASSET_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'alvely', 'assets')
+ASSET_CACHE_MB = env_float('ASSET_CACHE_MB', 200)
+# Entries without Cache-Control max-age are served unchecked for this long, then revalidated
+ASSET_FRESH_FOR = env_float('ASSET_FRESH_FOR', 60 * 60)
+
+
+def cache_control_max_age(header):
+    """ Seconds a response may be served without revalidation, or None if it must not be stored """
+    directives = [d.strip().lower() for d in (header or '').split(',')]
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0.0
+    for d in directives:
+        if d.startswith('max-age='):
+            try:
+                return max(0.0, float(d.split('=', 1)[1]))
+            except ValueError:
+                break
+    return ASSET_FRESH_FOR
+
+
+class AssetCache:
+    """
+    Size-bounded, content-addressed disk cache. Bodies are stored once per
+    sha256 under blobs/, an sqlite index maps URLs to them along with their
+    ETag/Last-Modified validators, and the least recently used URLs are
+    evicted first.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def db(self):
+        # Opened on first use so importing the module (e.g. in pool processes) touches no files
+        if self.conn is None:
+            os.makedirs(os.path.join(self.root, 'blobs'), exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite3'), check_same_thread=False)
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY, digest TEXT NOT NULL, etag TEXT, last_modified TEXT,
+                    expires REAL NOT NULL, last_used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS urls_last_used ON urls (last_used);
+                CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+            """)
+        return self.conn
+
+    def blobPath(self, digest):
+        return os.path.join(self.root, 'blobs', digest)
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db().execute(
+                "SELECT digest, etag, last_modified, expires FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+            if row and not os.path.exists(self.blobPath(row[0])):
+                self.db().execute("DELETE FROM urls WHERE url = ?", (url,))
+                self.db().commit()
+                return None
+            return row
+
+    def touch(self, url, expires=None):
+        with self.lock:
+            if expires is None:
+                self.db().execute("UPDATE urls SET last_used = ? WHERE url = ?", (time.time(), url))
+            else:
+                self.db().execute(
+                    "UPDATE urls SET last_used = ?, expires = ? WHERE url = ?", (time.time(), expires, url)
+                )
+            self.db().commit()
+
+    def read(self, digest):
+        # Under the lock so evict() cannot delete the blob mid-read; None if it is already gone
+        with self.lock:
+            try:
+                with open(self.blobPath(digest), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+    def store(self, url, data, etag, last_modified, expires):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blobPath(digest)
+        with self.lock:
+            db = self.db()
+            if not os.path.exists(path):
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            db.execute("INSERT OR REPLACE INTO blobs (digest, size) VALUES (?, ?)", (digest, len(data)))
+            db.execute(
+                "INSERT OR REPLACE INTO urls (url, digest, etag, last_modified, expires, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, digest, etag, last_modified, expires, time.time())
+            )
+            self.evict(keep=url)
+            db.commit()
+
+    def evict(self, keep=None):
+        # Caller holds the lock
+        db = self.db()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, digest in db.execute("SELECT url, digest FROM urls ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            if url == keep:
+                continue
+            db.execute("DELETE FROM urls WHERE url = ?", (url,))
+            if db.execute("SELECT 1 FROM urls WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                continue
+            size = db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            total -= size[0] if size else 0
+            try:
+                os.remove(self.blobPath(digest))
+            except OSError:
+                pass
+
+    def fetch(self, url, timeout=HTTP_TIMEOUT):
+        """ Return the body of url, from disk when fresh or confirmed unchanged by the server """
+        try:
+            return self.fetchCached(url, timeout)
+        except (OSError, sqlite3.Error) as e:
+            # requests' errors are OSErrors too, but a failed download is not the cache's fault
+            if isinstance(e, requests.RequestException):
+                raise
+            # A broken cache (unwritable directory, locked or corrupt index) must not break downloads
+            print(f"[DEBUG] Asset cache unavailable ({e}); fetching {url} uncached.")
+            resp = HTTP.get(url, timeout=timeout)
+            resp.raise_for_status()
+            return resp.content
+
+    def fetchCached(self, url, timeout):
+        row = self.lookup(url)
+        headers = {}
+        if row:
+            digest, etag, last_modified, expires = row
+            if time.time() < expires:
+                data = self.read(digest)
+                if data is not None:
+                    self.touch(url)
+                    return data
+            elif etag or last_modified:
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+
+        resp = HTTP.get(url, headers=headers, timeout=timeout)
+        max_age = cache_control_max_age(resp.headers.get('Cache-Control'))
+        if headers and resp.status_code == 304:
+            data = self.read(row[0])
+            if data is not None:
+                self.touch(url, time.time() + (max_age or 0))
+                return data
+            # Evicted since the lookup: ask again without validators
+            resp = HTTP.get(url, timeout=timeout)
+            max_age = cache_control_max_age(resp.headers.get('Cache-Control'))
+        resp.raise_for_status()
+        if max_age is not None:
+            self.store(url, resp.content, resp.headers.get('ETag'), resp.headers.get('Last-Modified'),
+                       time.time() + max_age)
+        return resp.content
+
+    def saveTo(self, url, dest):
+        # A cached body is copied straight from disk, without revalidating
+        try:
+            row = self.lookup(url)
+            data = self.read(row[0]) if row else None
+            if data is not None:
+                self.touch(url)
+        except (OSError, sqlite3.Error):
+            data = None
+        if data is None:
+            data = self.fetch(url)
+        with open(dest, 'wb') as f:
+            f.write(data)
+
+ASSET_CACHE = AssetCache(ASSET_CACHE_DIR, int(ASSET_CACHE_MB * 1024 * 1024))
+
+###############################################################################
+# CPU-heavy work (PDF rasterizing, base64, markdown) runs in a process pool so it
+# never competes with the GUI thread for the GIL. Thumbnails are decoded on a plain
+# thread instead: QImage releases the GIL while decoding, and shipping pixels back
+# from another process costs more than the decode.
+
+OFFLOAD_WORKERS = env_int('OFFLOAD_WORKERS', max(1, min(4, (os.cpu_count() or 2) - 1)))
+# Results at least this large come back through shared memory instead of the result pipe
+SHARED_MEMORY_MIN_BYTES = 256 * 1024
+# Shorter answers render faster in place than a round trip to another process
+OFFLOAD_MIN_CHARS = 2000
+THUMBNAIL_WIDTH = 300
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    # Created on first use; spawn keeps the children free of Qt state forked from the GUI
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=OFFLOAD_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _process_pool
+
+
+def discard_process_pool(pool):
+    # A crashed child breaks the whole pool; the next job starts a fresh one
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False)
+
+
+def warm_process_pool():
+    get_process_pool().submit(int)
+
+
+# Downloads feeding the pool run here, so a slow host only ties up a thread
+ASSET_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='assets')
+
+
+class SharedBytes:
+    """ Handle to bytes a pool process left in a shared memory block """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+def pack_bytes(data):
+    # Called in the pool process
+    if len(data) < SHARED_MEMORY_MIN_BYTES:
+        return data
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+    except OSError:
+        return data
+    shm.buf[:len(data)] = data
+    handle = SharedBytes(shm.name, len(data))
+    shm.close()
+    return handle
+
+
+def unpack_bytes(packed):
+    # Called in the GUI process; the block is freed once copied out
+    if not isinstance(packed, SharedBytes):
+        return packed
+    shm = shared_memory.SharedMemory(name=packed.name)
+    try:
+        return bytes(shm.buf[:packed.size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def render_markdown(message):
+    html = markdown.markdown(message, extensions=['fenced_code', 'tables'])
+    html = re.sub(r'\\\((.*?)\\\)', r'<i>\1</i>', html)
+    html = re.sub(r'\\\[(.*?)\\\]', r'<i>\1</i>', html)
+    return html
+
+
+def encode_file(path):
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+
+def png_bytes(path):
+    image = QImage(path)
+    if image.isNull():
+        raise ValueError(f"could not read image {os.path.basename(path)}")
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QBuffer.WriteOnly)
+    image.save(buf, 'PNG')
+    return bytes(data)
+
+
+def encode_file_job(path):
+    # The model APIs take PNG, JPEG, GIF and WebP only, so BMP is converted to PNG
+    if os.path.splitext(path)[1].lower() == '.bmp':
+        return pack_bytes(base64.b64encode(png_bytes(path)))
+    return pack_bytes(encode_file(path).encode('ascii'))
+
+
+def rasterize_pdf_job(path):
+    pages = []
+    for im in convert_from_path(path):
+        buf = io.BytesIO()
+        im.save(buf, 'PNG')
+        pages.append(pack_bytes(base64.b64encode(buf.getvalue())))
+    return pages
+
+
+def dhash(image):
+    """ 64-bit difference hash: left-to-right brightness steps of a 9x8 grayscale copy """
+    small = image.scaled(9, 8, Qt.IgnoreAspectRatio, Qt.SmoothTransformation).convertToFormat(QImage.Format_Grayscale8)
+    stride = small.bytesPerLine()
+    pixels = small.bits().asstring(small.sizeInBytes())
+    bits = 0
+    for y in range(8):
+        row = pixels[y * stride:y * stride + 9]
+        for x in range(8):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return bits
+
+
+def fetch_thumbnail(url, data, width):
+    """ Download (unless data is given), decode, scale and hash, all on the calling thread """
+    if data is None:
+        data = ASSET_CACHE.fetch(url)
+    image = QImage.fromData(data)
+    if image.isNull():
+        raise ValueError("no image data")
+    image = image.scaledToWidth(width, Qt.SmoothTransformation)
+    return data, image, dhash(image)
+
+
+class OffloadJob(QObject):
+    """ Carries a background job's outcome back to the GUI thread """
+    succeeded = pyqtSignal(object, object)  # tag, result
+    failed = pyqtSignal(object, str)        # tag, error message
+
+
+# Jobs in flight; each is dropped once its outcome has been delivered
+OFFLOAD_JOBS = set()
+
+
+def run_offloaded(fn, args, on_done, on_error=None, tag=None, executor=None, postprocess=None):
+    """
+    Run fn(*args) in the process pool (or the given executor) and deliver
+    on_done(tag, result) / on_error(tag, message) on the GUI thread. Pass bound
+    methods of widgets: Qt drops the call if the widget is gone by then.
+    postprocess runs off the GUI thread, in this process, before delivery.
+    Must be called from the GUI thread.
+    """
+    job = OffloadJob()
+    job.succeeded.connect(on_done)
+    if on_error is not None:
+        job.failed.connect(on_error)
+    job.succeeded.connect(lambda *_: OFFLOAD_JOBS.discard(job))
+    job.failed.connect(lambda *_: OFFLOAD_JOBS.discard(job))
+    OFFLOAD_JOBS.add(job)
+
+    pool = executor or get_process_pool()
+
+    def deliver(future):
+        try:
+            result = future.result()
+            if postprocess is not None:
+                result = postprocess(result)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool) and executor is None:
+                discard_process_pool(pool)
+            print(f"[DEBUG] Offloaded job {fn.__name__} failed: {e}")
+            job.failed.emit(tag, str(e) or type(e).__name__)
+            return
+        job.succeeded.emit(tag, result)
+
+    pool.submit(fn, *args).add_done_callback(deliver)
+
+###############################################################################
+# Large text/code uploads are chunked into a per-tab BM25 index, and only the
+# chunks relevant to the query go into the prompt
+
+# Smaller files are still inlined whole
+UPLOAD_INLINE_BYTES = env_int('UPLOAD_INLINE_BYTES', 32 * 1024)
+CHUNK_MIN_CHARS = 300
+CHUNK_MAX_CHARS = 1500
+CHUNK_MAX_LINES = 60
+# Upper bound on excerpt text added to a prompt, however large the uploads
+RETRIEVAL_MAX_CHARS = env_int('RETRIEVAL_MAX_CHARS', 12000)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Top-level definitions in Python/JS start a new chunk
+CODE_BOUNDARY_RE = re.compile(
+    r"^(?:@|(?:async\s+)?def\s|class\s|(?:async\s+)?function\s|export\s|module\.exports)"
+)
+IDENTIFIER_PART_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+def iter_chunks(lines, code):
+    """ Yield (first_line, last_line, text) chunks, split on definitions (code) or paragraphs (text) """
+    chunk = []
+    size = 0
+    first = 1
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\n')
+        if chunk:
+            if code:
+                # A decorator stays with the definition under it
+                boundary = bool(CODE_BOUNDARY_RE.match(line)) and not chunk[-1].startswith('@')
+                boundary = boundary and size >= CHUNK_MIN_CHARS
+            else:
+                boundary = not line.strip() and size >= CHUNK_MAX_CHARS // 2
+            if boundary or size >= CHUNK_MAX_CHARS or len(chunk) >= CHUNK_MAX_LINES:
+                yield first, number - 1, '\n'.join(chunk)
+                chunk, size, first = [], 0, number
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk and any(l.strip() for l in chunk):
+        yield first, first + len(chunk) - 1, '\n'.join(chunk)
+
+
+def retrieval_terms(text):
+    # Identifiers count whole and by their snake/camel-case parts
+    terms = []
+    for word in re.findall(r"[A-Za-z0-9_]+", text):
+        lower = word.lower()
+        if lower in STOPWORDS:
+            continue
+        terms.append(lower)
+        parts = [p.lower() for p in IDENTIFIER_PART_RE.findall(word)]
+        if len(parts) > 1:
+            terms.extend(p for p in parts if p not in STOPWORDS)
+    return terms
+
+
+class UploadDocument:
+    """ An indexed upload: its chunks, their lengths in terms, and term -> [(chunk, tf)] postings """
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = []
+        self.lengths = []
+        self.postings = {}
+
+    def add(self, first, last, text):
+        index = len(self.chunks)
+        self.chunks.append((first, last, text))
+        counts = {}
+        for term in retrieval_terms(text):
+            counts[term] = counts.get(term, 0) + 1
+        self.lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, []).append((index, tf))
+
+
+def index_upload_job(path, name, code):
+    # Runs in the process pool; the file is read line by line, never whole
+    doc = UploadDocument(name)
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for first, last, text in iter_chunks(f, code):
+            doc.add(first, last, text)
+    return doc
+
+
+def retrieve_chunks(documents, query, max_chars=RETRIEVAL_MAX_CHARS):
+    """ BM25 over every chunk of the given documents; best chunks up to max_chars, in file order """
+    total = sum(len(doc.chunks) for doc in documents)
+    if not total:
+        return []
+    avg_length = max(1.0, sum(sum(doc.lengths) for doc in documents) / total)
+    scores = {}
+    for term in set(retrieval_terms(query)):
+        df = sum(len(doc.postings.get(term, ())) for doc in documents)
+        if not df:
+            continue
+        idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+        for d, doc in enumerate(documents):
+            for index, tf in doc.postings.get(term, ()):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * doc.lengths[index] / avg_length)
+                scores[(d, index)] = scores.get((d, index), 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+    # Nothing matched: the start of each file is the best guess
+    ranked = sorted(scores, key=scores.get, reverse=True) or [(d, 0) for d in range(len(documents))]
+    picked = []
+    used = 0
+    for d, index in ranked:
+        first, last, text = documents[d].chunks[index]
+        if used + len(text) > max_chars:
+            if picked:
+                continue
+            text = text[:max_chars]
+        picked.append((d, first, last, documents[d].name, text))
+        used += len(text)
+    picked.sort()
+    return [(name, first, last, text) for _, first, last, name, text in picked]
+
+###############################################################################
+# Search results are reranked against the query before generation: hashed TF-IDF
+# relevance, then maximal marginal relevance so near-identical sources don't crowd the prompt
+
+# Sources passed to the model; every result is still shown in the sources panel
+RERANK_TOP_K = env_int('RERANK_TOP_K', 5)
+RERANK_FEATURES = 1 << 14
+# 1.0 is pure relevance; lower trades relevance for diversity
+MMR_LAMBDA = env_float('MMR_LAMBDA', 0.7)
+# Earlier user turns add context to the query, at this weight
+RERANK_CONTEXT_WEIGHT = 0.3
+RERANK_CONTEXT_TURNS = 2
+# Share of relevance taken from a result's own backend score (BM25 for local hits,
+# rank for Bing), when it has one; the rest is TF-IDF against the query
+RERANK_SCORE_WEIGHT = env_float('RERANK_SCORE_WEIGHT', 0.5)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def hashed_term_counts(texts):
+    """ Term counts of each text as rows of an (n, RERANK_FEATURES) matrix """
+    counts = np.zeros((len(texts), RERANK_FEATURES), dtype=np.float32)
+    for row, text in enumerate(texts):
+        buckets = [zlib.crc32(term.encode('utf-8')) % RERANK_FEATURES for term in retrieval_terms(text)]
+        np.add.at(counts[row], buckets, 1.0)
+    return counts
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-9)
+
+
+def rerank_sources(query, sources, context=(), top_k=RERANK_TOP_K, mmr_lambda=MMR_LAMBDA,
+                   score_weight=RERANK_SCORE_WEIGHT):
+    """ The top_k of sources by MMR over TF-IDF cosine with the query, blended with their score, best first """
+    if not sources:
+        return []
+    docs = [HTML_TAG_RE.sub(' ', f"{s['name']} {s['snippet']}") for s in sources]
+    counts = hashed_term_counts(docs + [query] + list(context))
+    n = len(docs)
+    # IDF over the candidates only: terms every result shares say nothing about rank
+    df = np.count_nonzero(counts[:n], axis=0)
+    idf = np.log((n + 1) / (df + 1)) + 1.0
+    vectors = normalize_rows(np.log1p(counts) * idf)
+    docs_v = vectors[:n]
+    query_v = vectors[n]
+    if len(vectors) > n + 1:
+        query_v = query_v + RERANK_CONTEXT_WEIGHT * vectors[n + 1:].sum(axis=0)
+    relevance = docs_v @ query_v
+    scored = np.array(['score' in s for s in sources])
+    if scored.any():
+        backend_scores = np.array([s.get('score', 0.0) for s in sources], dtype=np.float32)
+        relevance[scored] = (1 - score_weight) * relevance[scored] + score_weight * backend_scores[scored]
+    similarity = docs_v @ docs_v.T
+
+    picked = [int(np.argmax(relevance))]
+    redundancy = similarity[picked[0]].copy()
+    remaining = np.ones(n, dtype=bool)
+    remaining[picked[0]] = False
+    while len(picked) < min(top_k, n):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        remaining[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return [sources[i] for i in picked]
+
+###############################################################################
+# Answer cache: a repeated or rephrased question (also from another tab) reuses the
+# earlier answer. Before any calls only the same question (up to case, whitespace,
+# contractions and punctuation that carries no meaning) is served. Once the sources are known, a near-duplicate question
+# that found the very same sources is served too, so a light rephrasing still
+# skips generation.
+
+ANSWER_CACHE_TTL = env_float('ANSWER_CACHE_TTL', 60 * 60)
+ANSWER_CACHE_SIZE = 256
+# Word-sequence similarity (difflib ratio) at which two questions count as the same.
+# It follows word order, so "celsius to fahrenheit" does not match its reverse;
+# numbers and negations must also agree, so "python 2 install" never matches
+# "python 3 install".
+ANSWER_SIMILARITY = env_float('ANSWER_SIMILARITY', 0.75)
+NEGATION_WORDS = frozenset({'not', 'no', 'never', 'without', 'nor', 'none'})
+CONTRACTIONS = [(re.compile(pattern), expanded) for pattern, expanded in (
+    (r"\bwon't\b", "will not"), (r"\bcan't\b", "can not"), (r"(?<=[a-z])n't\b", " not"),
+    (r"(?<=[a-z])'re\b", " are"), (r"(?<=[a-z])'m\b", " am"), (r"(?<=[a-z])'ll\b", " will"),
+    (r"(?<=[a-z])'ve\b", " have"), (r"(?<=[a-z])'d\b", " would"), (r"(?<=[a-z])'s\b", " is")
+)]
+# Trimmed off the ends of words; '+' and '#' stay ("c++", "c#"), as do dots inside words
+WORD_LEADING_PUNCTUATION = "\"'`([{<"
+WORD_TRAILING_PUNCTUATION = "\"'`)]}>?!.,;:"
+
+
+def question_words(query):
+    """ The question's words, lowercased, contractions expanded, without punctuation that carries no meaning """
+    text = query.lower().replace('\u2019', "'")
+    for contraction, expanded in CONTRACTIONS:
+        text = contraction.sub(expanded, text)
+    words = (w.lstrip(WORD_LEADING_PUNCTUATION).rstrip(WORD_TRAILING_PUNCTUATION) for w in text.split())
+    return [w for w in words if w]
+
+
+def question_similarity(a, b):
+    """ Similarity in [0, 1] of two question_words() lists; 0 if their numbers or negations differ """
+    def pinned(words):
+        return [w for w in words if w in NEGATION_WORDS or any(c.isdigit() for c in w)]
+    if pinned(a) != pinned(b):
+        return 0.0
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def source_fingerprint(sources):
+    """ Order-independent hash of the canonical URLs an answer is built from """
+    return hash64("\n".join(sorted(canonicalize_url(s['url']) for s in sources)))
+
+
+def format_age(seconds):
+    if seconds < 60:
+        return "just now"
+    if seconds < 60 * 60:
+        return f"{int(seconds // 60)} min ago"
+    return f"{int(seconds // 3600)} h ago"
+
+
+class AnswerCache:
+    """
+    Answers by (model, earlier questions, normalized question, source fingerprint).
+    Without a fingerprint only the exact question matches; with one, also a
+    near-duplicate question (question_similarity) stored under the same fingerprint.
+    """
+
+    def __init__(self, max_size, ttl, threshold):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, model_id, context, query, fingerprint, answer, related, sources):
+        words = question_words(query)
+        key = (model_id, context, ' '.join(words), fingerprint)
+        entry = {
+            'stored_at': time.time(), 'words': words,
+            'answer': answer, 'related': tuple(related), 'sources': list(sources)
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get(self, model_id, context, query, fingerprint=None):
+        """ Newest live entry with the closest question at or above the threshold, or None """
+        words = question_words(query)
+        normalized = ' '.join(words)
+        now = time.time()
+        best_key = None
+        best_similarity = self.threshold
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if now - entry['stored_at'] > self.ttl:
+                    del self.entries[key]
+                    continue
+                if key[:2] != (model_id, context):
+                    continue
+                if key[2] == normalized and (fingerprint is None or key[3] == fingerprint):
+                    similarity = 1.0
+                elif fingerprint is not None and key[3] == fingerprint:
+                    similarity = question_similarity(words, entry['words'])
+                else:
+                    continue
+                # Oldest first, so a tie goes to the newer answer
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+            if best_key is None:
+                return None
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key]
+
+
+ANSWER_CACHE = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_SIMILARITY)
+
+###############################################################################
+# Per-request performance and cost telemetry
+
+# In model dropdown order
+MODEL_TIERS = {
+    'gpt-4o-mini': 'Fast',
+    'claude-3-5-haiku-latest': 'Faster',
+    'o1-mini': 'Fastest',
+    'gpt-4o': 'Smart',
+    'claude-3-5-sonnet-latest': 'Smarter',
+    'o1-preview': 'Smartest'
+}
+# Requests kept per tier, for percentiles and export
+TELEMETRY_WINDOW = env_int('TELEMETRY_WINDOW', 200)
+TELEMETRY_STAGES = ('expansion', 'search', 'rerank', 'fetch', 'generation', 'total')
+TELEMETRY_COUNTERS = (
+    'prompt_tokens', 'completion_tokens', 'model_calls',
+    'bing_calls', 'bing_cache_hits', 'bytes_downloaded', 'expansion_cache_hits', 'shared_calls',
+    'lookalike_images', 'local_results', 'answer_cache_hits'
+)
+TELEMETRY_FIELDS = (
+    ('started', 'tier', 'model', 'mode', 'kind', 'status', 'degraded') + TELEMETRY_STAGES + TELEMETRY_COUNTERS
+)
+
+
+class RequestStats:
+    """ Stage timings and counters for one Worker run; updated from its search/model threads """
+
+    def __init__(self, model_id, mode, kind):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.model_id = model_id
+        self.mode = mode
+        self.kind = kind
+        self.status = 'ok'
+        self.degraded = []
+        self.stages = {}
+        self.counters = dict.fromkeys(TELEMETRY_COUNTERS, 0)
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counters[name] += value or 0
+
+    @contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - started
+
+    def record(self):
+        with self.lock:
+            row = {
+                'started': round(self.started, 3),
+                'tier': MODEL_TIERS.get(self.model_id, self.model_id),
+                'model': self.model_id,
+                'mode': self.mode,
+                'kind': self.kind,
+                'status': self.status,
+                'degraded': '; '.join(self.degraded)
+            }
+            for name in TELEMETRY_STAGES:
+                row[name] = round(self.stages[name], 3) if name in self.stages else None
+            row.update(self.counters)
+        return row
+
+
+class Telemetry:
+    """ Recent request records per model tier, with rolling stage-latency percentiles """
+
+    def __init__(self, window):
+        self.window = window
+        self.records = {}
+        self.latency = LatencyTracker(window=window, min_samples=1)
+        self.lock = threading.Lock()
+
+    def add(self, stats):
+        row = stats.record()
+        with self.lock:
+            self.records.setdefault(row['tier'], deque(maxlen=self.window)).append(row)
+        # Speculative and failed runs say little about what the user waits for
+        if row['kind'] != 'speculative' and row['status'] == 'ok':
+            for name in TELEMETRY_STAGES:
+                if row[name] is not None:
+                    self.latency.record((row['tier'], name), row[name])
+
+    def rows(self):
+        with self.lock:
+            rows = [row for records in self.records.values() for row in records]
+        return sorted(rows, key=lambda row: row['started'])
+
+    def summary(self):
+        lines = []
+        with self.lock:
+            tiers = {tier: list(records) for tier, records in self.records.items()}
+        for tier, rows in tiers.items():
+            lines.append(f"{tier}: {len(rows)} requests")
+            for name in TELEMETRY_STAGES:
+                p50 = self.latency.percentile((tier, name), 50, None)
+                if p50 is not None:
+                    p95 = self.latency.percentile((tier, name), 95, None)
+                    lines.append(f"  {name}: p50 {p50:.2f}s, p95 {p95:.2f}s")
+            totals = {name: sum(row[name] for row in rows) for name in TELEMETRY_COUNTERS}
+            lines.append(
+                f"  tokens/req: {totals['prompt_tokens'] / len(rows):.0f} in, "
+                f"{totals['completion_tokens'] / len(rows):.0f} out"
+            )
+            lookups = totals['bing_calls'] + totals['bing_cache_hits']
+            hit_rate = totals['bing_cache_hits'] / lookups if lookups else 0.0
+            lines.append(
+                f"  Bing: {totals['bing_calls']} calls, {totals['bytes_downloaded'] / 1024:.0f} KB, "
+                f"{hit_rate:.0%} cached, {totals['shared_calls']} shared in flight"
+            )
+        return "\n".join(lines) or "No requests yet."
+
+    def export(self, path):
+        # CSV unless the file is named .jsonl
+        rows = self.rows()
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            if path.lower().endswith('.jsonl'):
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+            else:
+                writer = csv.DictWriter(f, fieldnames=TELEMETRY_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+        return len(rows)
+
+
+TELEMETRY = Telemetry(TELEMETRY_WINDOW)
+
+###############################################################################
+# Per-tier latency budgets: seconds from submit until the answer starts to appear
+# (for models that answer in one piece, until the answer is there)
+
+LATENCY_BUDGETS = {
+    'claude-3-5-haiku-latest': 4.0,
+    'gpt-4o-mini': 5.0,
+    'gpt-4o': 8.0,
+    'claude-3-5-sonnet-latest': 10.0,
+    'o1-mini': 15.0,
+    'o1-preview': 40.0
+}
+DEFAULT_LATENCY_BUDGET = 10.0
+# Cumulative fraction of the budget by which each stage must be done; time a stage
+# does not use carries over, and generation gets whatever is left
+BUDGET_SHARES = (('expansion', 0.35), ('search', 0.8), ('generation', 1.0))
+
+# Stages run here while the pipeline waits on them with a deadline; model calls
+# inside them may still use MODEL_EXECUTOR for hedging
+STAGE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='stage')
+
+
+class Deadlines:
+    """ Monotonic-clock deadline for each stage of one request """
+
+    def __init__(self, budget, start=None):
+        # start is when the query was submitted, so time queued in the pool counts too
+        start = time.monotonic() if start is None else start
+        self.ends = {name: start + budget * share for name, share in BUDGET_SHARES}
+
+    def remaining(self, name):
+        return max(0.0, self.ends[name] - time.monotonic())
+
+
+def budget_note(model_id, notes):
+    budget = LATENCY_BUDGETS.get(model_id, DEFAULT_LATENCY_BUDGET)
+    return f"To answer within {budget:g}s: " + "; ".join(notes) + "."
+
+###############################################################################
+# GUI stall watchdog (opt-in): a heartbeat timer measures event-loop latency, and a
+# side thread grabs the GUI thread's stack when the heartbeat stops
+
+WATCHDOG_ENABLED = env_flag('ALVELY_WATCHDOG')
+WATCHDOG_HEARTBEAT_MS = env_int('WATCHDOG_HEARTBEAT_MS', 50)
+# Stalls shorter than this are only counted in the latency percentiles
+WATCHDOG_STALL_MS = env_int('WATCHDOG_STALL_MS', 200)
+WATCHDOG_KEEP = 100
+
+
+class StallWatchdog(QObject):
+    """ Heartbeat on the GUI thread, watched from a daemon thread; stalls are logged with their call site """
+
+    def __init__(self, heartbeat_ms=WATCHDOG_HEARTBEAT_MS, stall_ms=WATCHDOG_STALL_MS):
+        super().__init__()
+        self.interval = heartbeat_ms / 1000
+        self.threshold = stall_ms / 1000
+        self.gui_thread = threading.get_ident()
+        self.latency = LatencyTracker(window=1000, min_samples=1)
+        self.stalls = deque(maxlen=WATCHDOG_KEEP)
+        self.lock = threading.Lock()
+        self.last_beat = time.monotonic()
+        # Stack of the stall in progress, set by the side thread
+        self.captured = None
+        self.stopped = threading.Event()
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.beat)
+
+    def start(self):
+        self.last_beat = time.monotonic()
+        self.timer.start(int(self.interval * 1000))
+        threading.Thread(target=self.watch, name='stall-watchdog', daemon=True).start()
+
+    def stop(self):
+        self.timer.stop()
+        self.stopped.set()
+
+    def beat(self):
+        now = time.monotonic()
+        with self.lock:
+            gap = now - self.last_beat
+            self.last_beat = now
+            captured, self.captured = self.captured, None
+        # How late this beat is: the time the event loop could not get to it
+        lag = max(0.0, gap - self.interval)
+        self.latency.record('lag', lag)
+        if lag >= self.threshold:
+            site, stack = captured or ('(not captured)', '')
+            with self.lock:
+                self.stalls.append((lag, site, stack, time.time()))
+            print(f"[DEBUG] GUI stalled {lag * 1000:.0f} ms in {site}")
+
+    def watch(self):
+        while not self.stopped.wait(self.interval / 2):
+            with self.lock:
+                stalled = time.monotonic() - self.last_beat - self.interval >= self.threshold
+                if not stalled or self.captured is not None:
+                    continue
+            frame = sys._current_frames().get(self.gui_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self.lock:
+                self.captured = (self.callSite(stack), ''.join(traceback.format_list(stack[-8:])))
+
+    def callSite(self, stack):
+        # Innermost frame in this program; library frames only say what blocked, not who called it
+        ours = [f for f in stack if os.path.abspath(f.filename) == os.path.abspath(__file__)]
+        frame = (ours or stack)[-1]
+        return f"{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})"
+
+    def summary(self, worst=5):
+        p50 = self.latency.percentile('lag', 50, 0.0)
+        p99 = self.latency.percentile('lag', 99, 0.0)
+        with self.lock:
+            stalls = list(self.stalls)
+        lines = [f"GUI lag: p50 {p50 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms, {len(stalls)} stalls"]
+        by_site = {}
+        for lag, site, _, _ in stalls:
+            count, total, longest = by_site.get(site, (0, 0.0, 0.0))
+            by_site[site] = (count + 1, total + lag, max(longest, lag))
+        for site, (count, total, longest) in sorted(by_site.items(), key=lambda kv: -kv[1][1])[:worst]:
+            lines.append(f"  {site}: {count}x, worst {longest * 1000:.0f} ms, total {total * 1000:.0f} ms")
+        return "\n".join(lines)
+
+
+# Created in main when ALVELY_WATCHDOG is set
+WATCHDOG = None
+
+###############################################################################
+# Models that answer in one piece; their answer is delivered as a single chunk
+NON_STREAMING_MODELS = {'o1-mini', 'o1-preview'}
+
+OPENAI_MODELS = ['gpt-4o', 'gpt-4o-mini', 'o1-mini', 'o1-preview']
+# Models that accept image (and rasterized PDF) uploads
+VISION_MODELS = ['gpt-4o', 'gpt-4o-mini', 'claude-3-5-sonnet-latest']
+
+# Expanded queries are searched concurrently; the Bing rate limit still applies
+SEARCH_CONCURRENCY = env_int('SEARCH_CONCURRENCY', 4)
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_CONCURRENCY, thread_name_prefix='search')
+
+###############################################################################
+# Search backends: every text query goes to Bing and, when configured, to a local
+# document corpus at the same time; results are merged by score
+
+# Directory of text, markdown, code and PDFs searched alongside the web (off when unset)
+LOCAL_CORPUS_DIR = os.getenv('ALVELY_CORPUS_DIR') or None
+LOCAL_CORPUS_INDEX = os.getenv('ALVELY_CORPUS_INDEX') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'alvely', 'corpus.sqlite3'
+)
+# The directory is rescanned this often; only new, changed and deleted files are touched
+CORPUS_RESCAN_SECONDS = env_float('CORPUS_RESCAN_SECONDS', 30)
+CORPUS_TEXT_EXTENSIONS = {'.txt', '.md', '.markdown', '.rst'}
+CORPUS_CODE_EXTENSIONS = {'.py', '.js', '.ts', '.java', '.c', '.h', '.cpp', '.cs', '.go', '.rs', '.rb', '.sh'}
+CORPUS_MAX_FILE_BYTES = 5 * 1024 * 1024
+LOCAL_RESULTS = env_int('LOCAL_RESULTS', 3)
+# BM25 score at which a local hit ranks level with Bing's top result
+LOCAL_SCORE_HALF = 8.0
+# Once local hits are in, slower backends (Bing retrying while offline) get only this much longer
+LOCAL_HIT_GRACE = env_float('LOCAL_HIT_GRACE', 1.5)
+LOCAL_SNIPPET_CHARS = 300
+
+
+class LocalCorpus:
+    """
+    On-disk BM25 index of a directory, chunked like large uploads. A rescan only
+    reindexes files whose size or mtime changed and drops files that are gone,
+    so the index stays current without rereading the whole directory.
+    """
+
+    def __init__(self, root, path):
+        self.root = os.path.abspath(root)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.stopped = threading.Event()
+
+    def db(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, first INTEGER NOT NULL,
+                    last INTEGER NOT NULL, length INTEGER NOT NULL, text TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS chunks_file ON chunks (file_id);
+                CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, chunk_id INTEGER NOT NULL, tf INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+                CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk_id);
+            """)
+        return self.conn
+
+    def start(self):
+        threading.Thread(target=self.watch, name='corpus-indexer', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def watch(self):
+        while not self.stopped.is_set():
+            try:
+                changed = self.refresh()
+                if changed:
+                    print(f"[DEBUG] Corpus: indexed {changed} files under {self.root}.")
+            except Exception as e:
+                print(f"[DEBUG] Corpus rescan failed: {e}")
+            self.stopped.wait(CORPUS_RESCAN_SECONDS)
+
+    def kind(self, path):
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.pdf':
+            return 'pdf'
+        if ext in CORPUS_CODE_EXTENSIONS:
+            return 'code'
+        if ext in CORPUS_TEXT_EXTENSIONS:
+            return 'text'
+        return None
+
+    def scan(self):
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if self.kind(path) is None:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if st.st_size <= CORPUS_MAX_FILE_BYTES:
+                    found[path] = (st.st_mtime, st.st_size)
+        return found
+
+    def refresh(self):
+        """ Bring the index up to date with the directory; returns how many files were (re)indexed """
+        found = self.scan()
+        with self.lock:
+            known = {path: (mtime, size) for path, mtime, size in self.db().execute("SELECT path, mtime, size FROM files")}
+        for path in set(known) - set(found):
+            self.remove(path)
+        changed = [path for path, stamp in found.items() if known.get(path) != stamp]
+        for path in changed:
+            if self.stopped.is_set():
+                break
+            self.index(path, *found[path])
+        return len(changed)
+
+    def readLines(self, path, kind):
+        if kind == 'pdf':
+            # Text layer only, via poppler's pdftotext (pdf2image needs poppler anyway)
+            out = subprocess.run(['pdftotext', '-layout', path, '-'], capture_output=True, timeout=60, check=True)
+            return out.stdout.decode('utf-8', errors='replace').splitlines()
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.readlines()
+
+    def index(self, path, mtime, size):
+        # Read and tokenized outside the lock; searches only wait for the writes
+        kind = self.kind(path)
+        try:
+            lines = self.readLines(path, kind)
+        except Exception as e:
+            # Still recorded, so an unreadable file is not retried until it changes
+            print(f"[DEBUG] Corpus: could not read {path}: {e}")
+            lines = []
+        chunks = [(first, last, text, retrieval_terms(text)) for first, last, text in iter_chunks(lines, kind == 'code')]
+        with self.lock:
+            db = self.db()
+            self.deleteFile(db, path)
+            file_id = db.execute(
+                "INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)", (path, mtime, size)
+            ).lastrowid
+            for first, last, text, terms in chunks:
+                chunk_id = db.execute(
+                    "INSERT INTO chunks (file_id, first, last, length, text) VALUES (?, ?, ?, ?, ?)",
+                    (file_id, first, last, len(terms), text)
+                ).lastrowid
+                counts = {}
+                for term in terms:
+                    counts[term] = counts.get(term, 0) + 1
+                db.executemany(
+                    "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+                    [(term, chunk_id, tf) for term, tf in counts.items()]
+                )
+            db.commit()
+
+    def remove(self, path):
+        with self.lock:
+            self.deleteFile(self.db(), path)
+            self.db().commit()
+
+    def deleteFile(self, db, path):
+        row = db.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row:
+            db.execute("DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE file_id = ?)", row)
+            db.execute("DELETE FROM chunks WHERE file_id = ?", row)
+            db.execute("DELETE FROM files WHERE id = ?", row)
+
+    def search(self, query, limit):
+        """ Best chunk of each of the top `limit` files: [(bm25, path, first, last, text)] """
+        terms = set(retrieval_terms(query))
+        if not terms:
+            return []
+        with self.lock:
+            db = self.db()
+            total, avg_length = db.execute("SELECT COUNT(*), AVG(length) FROM chunks").fetchone()
+            if not total:
+                return []
+            avg_length = max(1.0, avg_length or 0.0)
+            scores = {}
+            for term in terms:
+                rows = db.execute(
+                    "SELECT p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c ON c.id = p.chunk_id "
+                    "WHERE p.term = ?", (term,)
+                ).fetchall()
+                if not rows:
+                    continue
+                idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+                for chunk_id, tf, length in rows:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+            hits = []
+            seen_paths = set()
+            for chunk_id in sorted(scores, key=scores.get, reverse=True):
+                path, first, last, text = db.execute(
+                    "SELECT f.path, c.first, c.last, c.text FROM chunks c JOIN files f ON f.id = c.file_id "
+                    "WHERE c.id = ?", (chunk_id,)
+                ).fetchone()
+                # One source per file; its URL is the file, so more would be deduplicated anyway
+                if path in seen_paths:
+                    continue
+                seen_paths.add(path)
+                hits.append((scores[chunk_id], path, first, last, text))
+                if len(hits) >= limit:
+                    break
+        return hits
+
+
+class SearchBackend:
+    """ A source of text-mode results; search() returns result dicts with a 'score' in [0, 1) """
+    name = 'backend'
+    # Seconds the other backends are still waited for once this one has results; None waits for all
+    grace = None
+
+    def search(self, worker, query):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return self.name
+
+
+class BingBackend(SearchBackend):
+    name = 'bing'
+
+    def search(self, worker, query):
+        # Bing gives only a rank; its top result scores level with a local hit of LOCAL_SCORE_HALF
+        results = worker.bing_web_search(query)
+        return [dict(r, score=0.5 / (1 + 0.5 * rank)) for rank, r in enumerate(results)]
+
+
+class LocalCorpusBackend(SearchBackend):
+    name = 'local'
+    grace = LOCAL_HIT_GRACE
+
+    def __init__(self, corpus, limit=LOCAL_RESULTS):
+        self.corpus = corpus
+        self.limit = limit
+
+    def search(self, worker, query):
+        hits = self.corpus.search(query, self.limit)
+        worker.stats.add(local_results=len(hits))
+        results = []
+        for bm25, path, first, last, text in hits:
+            relative = os.path.relpath(path, self.corpus.root)
+            results.append({
+                'name': f"{relative} (lines {first}-{last})",
+                'url': QUrl.fromLocalFile(path).toString(),
+                'snippet': ' '.join(text.split())[:LOCAL_SNIPPET_CHARS],
+                'displayUrl': relative,
+                # The whole chunk goes into the prompt, not just the snippet
+                'content': text,
+                'score': bm25 / (bm25 + LOCAL_SCORE_HALF)
+            })
+        return results
+
+
+LOCAL_CORPUS = LocalCorpus(LOCAL_CORPUS_DIR, LOCAL_CORPUS_INDEX) if LOCAL_CORPUS_DIR else None
+SEARCH_BACKENDS = [BingBackend()] + ([LocalCorpusBackend(LOCAL_CORPUS)] if LOCAL_CORPUS else [])
+
+
 class Worker(QObject):
+    queries_ready = pyqtSignal(list)
+    answer_chunk = pyqtSignal(str)
     result_ready = pyqtSignal(str)
     sources_ready = pyqtSignal(list)
     images_ready = pyqtSignal(list)
@@ -48,7 +2162,17 @@ class Worker(QObject):
         self, query, conversation_history, client, anthropic_client,
         bing_api_key, uploaded_files, mode, model_id,
         fetched_urls=None,
-        fetched_image_urls=None
+        fetched_image_urls=None,
+        image_hashes=None,
+        search_backends=None,
+        use_answer_cache=True,
+        speculative=False,
+        cancel_event=None,
+        more=False,
+        link_paging=None,
+        image_paging=None,
+        upload_documents=None,
+        submitted_at=None
     ):
         super().__init__()
         self.query = query
@@ -57,111 +2181,378 @@ class Worker(QObject):
         self.anthropic_client = anthropic_client
         self.bing_api_key = bing_api_key
         self.uploaded_files = uploaded_files.copy()
+        # Indexed large uploads of this tab; only their relevant chunks are sent
+        self.upload_documents = list(upload_documents or [])
+        self.upload_excerpts = None
         self.mode = mode
         self.model_id = model_id
-        self.fetched_urls = fetched_urls if fetched_urls is not None else set()
-        self.fetched_image_urls = fetched_image_urls if fetched_image_urls is not None else set()
+        self.fetched_urls = fetched_urls if fetched_urls is not None else ResultDeduper()
+        self.fetched_image_urls = fetched_image_urls if fetched_image_urls is not None else ResultDeduper()
+        self.image_hashes = image_hashes if image_hashes is not None else ImageHashIndex()
+        self.search_backends = search_backends if search_backends is not None else SEARCH_BACKENDS
+        # Off for a refresh; attachments change the answer, so those are never cached
+        self.use_answer_cache = use_answer_cache and not (self.uploaded_files or self.upload_documents)
+        # The cache entry the answer came from, if it did
+        self.cached_answer = None
+        self.speculative = speculative
+        self.more = more
+        self.link_paging = link_paging if link_paging is not None else PagingState(query)
+        self.image_paging = image_paging if image_paging is not None else PagingState(query)
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        kind = 'speculative' if speculative else 'more' if more else 'query'
+        self.stats = RequestStats(model_id, mode, kind)
+        # Set for a typed text query, counting from submitted_at; the stages cut short
+        # to stay in budget say so here
+        self.submitted_at = submitted_at
+        self.deadlines = None
+        self.budget_notes = []
 
     def run(self):
         try:
-            if self.mode == 'text':
-                # If there's already an assistant answer, we do the "More" approach:
-                if any(msg['role'] == 'assistant' for msg in self.conversation_history):
-                    # Just fetch more links from the user’s single typed query, no AI
-                    new_links = self.fetchMoreLinks(self.query)
+            # Cancelled while still queued in the pool
+            self.checkCancelled()
+            stage = self.stats.stage
+            if self.speculative:
+                self.warmCaches()
+            elif self.mode == 'text':
+                if self.more:
+                    # Just fetch the next page of links for the user’s single typed query, no AI
+                    with stage('search'):
+                        new_links = self.fetchMoreLinks(self.query)
                     self.sources_ready.emit(new_links)
+                    self.prefetchNextLinks(self.query)
                 else:
-                    # Normal approach: get related queries => search => AI summarization
-                    related = self.getRelatedQueries(self.query)
-                    all_links = self.getSearchResults(related)
-                    new_links = []
-                    for link in all_links:
-                        if link['url'] not in self.fetched_urls:
-                            self.fetched_urls.add(link['url'])
-                            new_links.append(link)
-                    content_map = self.getWebsiteContents(new_links)
-                    ai_answer = self.generateResponse(self.query, content_map)
+                    # Normal approach: get related queries => search => AI summarization,
+                    # emitting each stage as soon as it is done
+                    self.deadlines = Deadlines(
+                        LATENCY_BUDGETS.get(self.model_id, DEFAULT_LATENCY_BUDGET), self.submitted_at
+                    )
+                    context = tuple(normalize_query(q) for q in self.previousQuestions())
+                    with stage('total'):
+                        if self.use_answer_cache:
+                            self.cached_answer = ANSWER_CACHE.get(self.model_id, context, self.query)
+                        if self.cached_answer:
+                            # Asked before: no model or search calls at all
+                            self.stats.add(answer_cache_hits=1)
+                            self.queries_ready.emit(list(self.cached_answer['related']))
+                            self.emitNewLinks(self.query, self.cached_answer['sources'])
+                            ai_answer = self.cached_answer['answer']
+                        else:
+                            ai_answer = self.answerQuery(context)
                     self.result_ready.emit(ai_answer)
-                    self.sources_ready.emit(new_links)
+                    # The first "More" pages the typed query from offset 0; have it ready
+                    self.prefetchNextLinks(self.query)
 
             elif self.mode == 'image':
-                # Always do AI-based approach => skip duplicates
-                related = self.getRelatedQueries(self.query)
-                all_imgs = self.getImageResults(related)
-                new_images = []
-                for img in all_imgs:
-                    if img['thumbnailUrl'] not in self.fetched_image_urls:
-                        self.fetched_image_urls.add(img['thumbnailUrl'])
-                        new_images.append(img)
-                self.images_ready.emit(new_images)
-
+                paging = self.image_paging
+                with stage('total'):
+                    if self.more and paging.related:
+                        # Next page from the stored cursors, no model call
+                        related = paging.related
+                    else:
+                        with stage('expansion'):
+                            related = self.getRelatedQueries(self.query)
+                        paging.related = related
+                    # Each query's batch goes to the grid as soon as its search returns
+                    with stage('search'):
+                        new_images = self.getImageResults(related, on_results=self.emitNewImages)
+                if not new_images:
+                    self.images_ready.emit([])
+                self.prefetchNextImages(related)
+
+        except Cancelled:
+            self.stats.status = 'cancelled'
+            print(f"[DEBUG] Worker for '{self.query}' cancelled.")
         except Exception as e:
+            self.stats.status = 'error'
             self.error_occurred.emit(str(e))
         finally:
+            TELEMETRY.add(self.stats)
             self.finished.emit()
 
+    def checkCancelled(self):
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+    def answerQuery(self, context):
+        stage = self.stats.stage
+        with stage('expansion'):
+            related = self.getRelatedQueries(self.query)
+        self.queries_ready.emit(related)
+        with stage('search'):
+            new_links = self.getSearchResults(related, on_results=self.emitNewLinks)
+        with stage('rerank'):
+            ranked = rerank_sources(self.query, new_links, self.conversationContext())
+        with stage('fetch'):
+            content_map = self.getWebsiteContents(ranked)
+        self.stats.degraded = list(self.budget_notes)
+
+        fingerprint = source_fingerprint(ranked)
+        if self.use_answer_cache:
+            # A rephrasing that found the same sources
+            self.cached_answer = ANSWER_CACHE.get(self.model_id, context, self.query, fingerprint)
+            if self.cached_answer:
+                self.stats.add(answer_cache_hits=1)
+                return self.cached_answer['answer']
+        cut_short = bool(self.budget_notes)
+        first_output = []
+
+        def on_chunk(delta):
+            if not first_output:
+                first_output.append(time.monotonic())
+            self.answer_chunk.emit(delta)
+
+        with stage('generation'):
+            ai_answer = self.generateResponse(self.query, content_map, on_chunk=on_chunk)
+        # Generation is never cut off, but starting late (for one-piece models, finishing
+        # late) is still reported
+        late = (first_output[0] if first_output else time.monotonic()) - self.deadlines.ends['generation']
+        if late > 0:
+            self.budget_notes.append(f"answer started {late:.2g}s late")
+            self.stats.degraded = list(self.budget_notes)
+        # An answer cut short to keep to the budget is not worth serving again
+        if not cut_short and not self.uploaded_files and not self.upload_documents:
+            ANSWER_CACHE.put(self.model_id, context, self.query, fingerprint, ai_answer, related, ranked)
+        return ai_answer
+
+    def warmCaches(self):
+        # Speculative run: fill the expansion and first-page search caches, emit nothing
+        related = self.getRelatedQueries(self.query)
+        search_fn = self.bing_web_search if self.mode == 'text' else self.bing_image_search
+        for q in related:
+            self.checkCancelled()
+            try:
+                search_fn(q)
+            except Exception as e:
+                print(f"[DEBUG] Speculative search for '{q}' failed: {e}")
+
     def fetchMoreLinks(self, query):
-        # Single typed query, skip duplicates
+        # Single typed query, paged by offset; skip pages that only hold duplicates
+        paging = self.link_paging
         new_links = []
-        results = self.bing_web_search(query)
-        for r in results:
-            if r['url'] not in self.fetched_urls:
-                self.fetched_urls.add(r['url'])
-                new_links.append(r)
+        for _ in range(MAX_PAGE_SKIPS):
+            if paging.isExhausted(query):
+                break
+            offset = paging.offset(query)
+            results = self.bing_web_search(query, offset=offset)
+            paging.advance(query, offset + LINKS_PER_PAGE, exhausted=not results)
+            new_links = self.filterNewLinks(results)
+            if new_links:
+                break
+        return new_links
+
+    def prefetchNextLinks(self, query):
+        # Warm the search cache with the next page so the following "More" is instant
+        if self.link_paging.isExhausted(query):
+            return
+        try:
+            self.bing_web_search(query, offset=self.link_paging.offset(query))
+        except Exception as e:
+            print(f"[DEBUG] Prefetch of next page for '{query}' failed: {e}")
+
+    def emitNewLinks(self, query, links):
+        new_links = self.filterNewLinks(links)
+        if new_links:
+            self.sources_ready.emit(new_links)
         return new_links
 
+    def filterNewLinks(self, links):
+        # Canonical URL + title/snippet SimHash, so mirrors and tracking variants drop out
+        return [
+            link for link in links
+            if not self.fetched_urls.seen(link['url'], f"{link['name']} {link['snippet']}")
+        ]
+
+    def emitNewImages(self, query, images):
+        new_images = self.dropLookalikes(self.filterNewImages(images))
+        if new_images:
+            self.images_ready.emit(new_images)
+        return new_images
+
+    def filterNewImages(self, images):
+        new_images = []
+        for img in images:
+            thumb_seen = self.fetched_image_urls.seen(img['thumbnailUrl'])
+            content_seen = bool(img['contentUrl']) and self.fetched_image_urls.seen(img['contentUrl'])
+            if not (thumb_seen or content_seen):
+                new_images.append(img)
+        return new_images
+
+    def dropLookalikes(self, images):
+        # Thumbnails are fetched and hashed here, so copies of one photo from other
+        # CDNs or sizes never get a widget; kept images carry their decoded thumbnail.
+        # Their URLs are already in fetched_image_urls, so later pages skip them unfetched.
+        kept = []
+        for img, thumbnail in zip(images, ASSET_EXECUTOR.map(self.loadThumbnail, images)):
+            self.checkCancelled()
+            if thumbnail is not None:
+                data, image, fingerprint = thumbnail
+                if self.image_hashes.seen(fingerprint):
+                    self.stats.add(lookalike_images=1)
+                    continue
+                img = dict(img, thumbnail=(data, image))
+            kept.append(img)
+        return kept
+
+    def loadThumbnail(self, img):
+        # A failed load is left to the widget, which shows it as unavailable
+        try:
+            return fetch_thumbnail(img['thumbnailUrl'], None, THUMBNAIL_WIDTH)
+        except Exception as e:
+            print(f"[DEBUG] Thumbnail for '{img['thumbnailUrl']}' failed: {e}")
+            return None
+
     def getRelatedQueries(self, query):
         prompt_text = (
             f"Generate a list of detailed search queries that expand upon the topic: '{query}'. "
             "Provide each query on a new line."
         )
-        messages = [{"role": "system", "content": "You are an assistant that generates related search queries."}]
-
-        if self.uploaded_files:
-            user_content = [{"type": "text", "text": prompt_text}]
-            for file in self.uploaded_files:
-                if file['type'] == 'image':
-                    user_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{file['data']}"}
-                    })
-                else:
-                    user_content.append({
-                        "type": "text",
-                        "text": f"Additional context from uploaded {file['type']} file:\n{file['data']}"
-                    })
-            messages.append({"role": "user", "content": user_content})
-        else:
-            messages.append({"role": "user", "content": prompt_text})
-
-        if self.model_id in ['gpt-4o', 'gpt-4o-mini', 'o1-mini', 'o1-preview']:
-            comp = self.client.chat.completions.create(
-                model=self.model_id,
-                messages=messages
-            )
-            return [x.strip('- ').strip() for x in comp.choices[0].message.content.split('\n') if x.strip()]
-        else:
-            anthro_resp = self.anthropic_client.completions.create(
-                model=self.model_id,
-                max_tokens_to_sample=1024,
-                prompt=anthropic.HUMAN_PROMPT + prompt_text + anthropic.AI_PROMPT
-            )
-            lines = anthro_resp.completion.strip().split('\n')
-            return [x.strip('- ').strip() for x in lines if x.strip()]
-
-    def getSearchResults(self, queries):
+        messages = [
+            {"role": "system", "content": "You are an assistant that generates related search queries."},
+            {"role": "user", "content": self.userContent(prompt_text)}
+        ]
+
+        # Uploaded files change the prompt, so only plain queries are cached
+        attached = self.uploaded_files or self.upload_documents
+        cache_key = None if attached else (self.model_id, normalize_query(query))
+        if cache_key:
+            cached = EXPANSION_CACHE.get(cache_key)
+            if cached is not None:
+                print(f"[DEBUG] Expansion cache hit for '{query}'.")
+                self.stats.add(expansion_cache_hits=1)
+                return list(cached)
+
+        self.checkCancelled()
+
+        def call(cancel_event):
+            lines = self.callModel(messages, cancel_event=cancel_event).split('\n')
+            max_queries = MAX_RELATED_QUERIES.get(self.model_id, DEFAULT_MAX_RELATED_QUERIES)
+            related = process_related_queries(query, lines, max_queries)
+            if cache_key:
+                EXPANSION_CACHE.put(cache_key, tuple(related))
+            return related
+
+        def expand(cancel_event):
+            if not cache_key:
+                return call(cancel_event)
+            # Another tab asking the same thing waits for that answer instead
+            related, shared = IN_FLIGHT.do(('expansion',) + cache_key, lambda: call(cancel_event), cancel_event)
+            if shared:
+                self.stats.add(shared_calls=1)
+            return list(related)
+
+        if self.deadlines is None:
+            return expand(self.cancel_event)
+        # Out of budget: search the question as typed, and stop the expansion. Its own
+        # cancel event is set then, or when the whole request is cancelled.
+        stage_cancel = threading.Event()
+        future = STAGE_EXECUTOR.submit(expand, stage_cancel)
+        try:
+            return self.waitStage(future, 'expansion')
+        except FutureTimeout:
+            self.budget_notes.append("query expansion skipped")
+            return [query]
+        finally:
+            if not future.done():
+                stage_cancel.set()
+                future.cancel()
+
+    def waitStage(self, future, name):
+        # Like future.result(timeout=...) up to the stage deadline, but a cancelled
+        # request stops waiting straight away
+        while True:
+            self.checkCancelled()
+            remaining = self.deadlines.remaining(name)
+            try:
+                return future.result(timeout=min(remaining, 0.1))
+            except FutureTimeout:
+                if remaining <= 0.1:
+                    raise
+
+    def getSearchResults(self, queries, on_results=None):
+        # Every query goes to every backend at once; one backend failing (e.g. Bing
+        # while offline) still leaves the others. Merged best score first.
+        tasks = [(q, backend) for q in queries for backend in self.search_backends]
+        found = self.searchEach(
+            tasks, lambda task: task[1].search(self, task[0]),
+            on_results and (lambda task, results: on_results(task[0], results)),
+            grace=lambda task, results: task[1].grace if results else None
+        )
+        return sorted(found, key=lambda r: r.get('score', 0.0), reverse=True)
+
+    def searchEach(self, queries, search_fn, on_results=None, grace=None):
+        # Queries run concurrently. One failed query drops out; only fail the request
+        # if every query failed. on_results(query, results) is called on this thread,
+        # in completion order, and returns what to keep.
+        # Past the search deadline the pipeline goes on with what has returned; so it
+        # does once grace(query, results) seconds have passed since it returned a number.
         results = []
-        for q in queries:
-            results.extend(self.bing_web_search(q))
+        errors = []
+        futures = {SEARCH_EXECUTOR.submit(search_fn, q): q for q in queries}
+        end = self.deadlines.ends['search'] if self.deadlines else None
+        pending = set(futures)
+        while pending:
+            timeout = None if end is None else max(0.0, end - time.monotonic())
+            done, pending = wait_futures(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                q = futures[future]
+                try:
+                    found = future.result()
+                except Exception as e:
+                    print(f"[DEBUG] Search for '{q}' failed: {e}")
+                    errors.append(e)
+                    continue
+                results.extend(on_results(q, found) if on_results else found)
+                seconds = grace(q, found) if grace else None
+                if seconds is not None:
+                    cutoff = time.monotonic() + seconds
+                    end = cutoff if end is None else min(end, cutoff)
+        if pending:
+            self.budget_notes.append(f"{len(queries) - len(pending)} of {len(queries)} searches used")
+            # Searches still queued are not worth starting any more
+            for future in pending:
+                future.cancel()
+        if errors and len(errors) == len(queries):
+            raise errors[0]
         return results
 
-    def bing_web_search(self, query):
-        search_url = "https://api.bing.microsoft.com/v7.0/search"
+    def bing_get(self, url, params):
+        key_params = dict(params, q=normalize_query(params['q']))
+        cache_key = (url, tuple(sorted(key_params.items())))
+        cached = SEARCH_CACHE.get(cache_key)
+        if cached is not None:
+            self.stats.add(bing_cache_hits=1)
+            return cached
+
+        def fetch():
+            data = self.bing_fetch(url, params)
+            SEARCH_CACHE.put(cache_key, data)
+            return data
+
+        data, shared = IN_FLIGHT.do(('bing',) + cache_key, fetch, self.cancel_event)
+        if shared:
+            self.stats.add(shared_calls=1)
+        return data
+
+    def bing_fetch(self, url, params):
         headers = {"Ocp-Apim-Subscription-Key": self.bing_api_key}
-        params = {"q": query, "textDecorations": True, "textFormat": "HTML", "count": 2}
-        r = requests.get(search_url, headers=headers, params=params)
-        r.raise_for_status()
-        data = r.json()
+
+        def get():
+            r = HTTP.get(url, headers=headers, params=params, timeout=HTTP_TIMEOUT)
+            self.stats.add(bing_calls=1, bytes_downloaded=len(r.content))
+            r.raise_for_status()
+            return r.json()
+
+        return call_with_retry('bing', get)
+
+    def bing_web_search(self, query, offset=0):
+        search_url = "https://api.bing.microsoft.com/v7.0/search"
+        params = {"q": query, "textDecorations": True, "textFormat": "HTML", "count": LINKS_PER_PAGE}
+        if offset:
+            params["offset"] = offset
+        data = self.bing_get(search_url, params)
         found = []
         if 'webPages' in data:
             for v in data['webPages']['value']:
@@ -173,13 +2564,24 @@ class Worker(QObject):
                 })
         return found
 
+    def previousQuestions(self):
+        # The typed questions before this one; attachments and answers are left out.
+        # Asking the same thing again (e.g. a refresh) does not count as new context.
+        asked = [m['content'] for m in self.conversation_history if m['role'] == 'user' and isinstance(m['content'], str)]
+        while asked and normalize_query(asked[-1]) == normalize_query(self.query):
+            asked.pop()
+        return asked
+
+    def conversationContext(self):
+        return self.previousQuestions()[-RERANK_CONTEXT_TURNS:]
+
     def getWebsiteContents(self, search_results):
         out = {}
         for item in search_results:
-            out[item['url']] = f"{item['name']}: {item['snippet']}"
+            out[item['url']] = f"{item['name']}: {item.get('content', item['snippet'])}"
         return out
 
-    def generateResponse(self, query, website_contents):
+    def generateResponse(self, query, website_contents, on_chunk=None):
         sources = "\n".join([f"{txt} (Source: {url})" for url, txt in website_contents.items()])
         prompt_text = (
             f"Using the following information from various sources, answer the query: \"{query}\" "
@@ -188,57 +2590,272 @@ class Worker(QObject):
             "Provide a detailed answer, and include the URLs of the sources you used."
         )
         messages = self.conversation_history.copy()
-
-        if self.uploaded_files:
-            user_content = [{"type": "text", "text": prompt_text}]
-            for file in self.uploaded_files:
-                if file['type'] == 'image':
-                    user_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{file['data']}"}
-                    })
-                else:
-                    user_content.append({
-                        "type": "text",
-                        "text": f"Additional context from uploaded {file['type']} file:\n{file['data']}"
-                    })
-            messages.append({"role": "user", "content": user_content})
+        messages.append({"role": "user", "content": self.userContent(prompt_text)})
+        return self.callModel(messages, on_chunk)
+
+    def userContent(self, prompt_text):
+        # Attachments go before the instruction so they are part of the cacheable prefix
+        excerpts = self.uploadExcerpts()
+        if not self.uploaded_files and not excerpts:
+            return prompt_text
+        user_content = []
+        for file in self.uploaded_files:
+            if file['type'] == 'image':
+                user_content.append({
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/png;base64,{file['data']}"}
+                })
+            else:
+                user_content.append({
+                    "type": "text",
+                    "text": f"Additional context from uploaded {file['type']} file:\n{file['data']}"
+                })
+        if excerpts:
+            user_content.append({"type": "text", "text": excerpts})
+        user_content.append({"type": "text", "text": prompt_text})
+        return user_content
+
+    def uploadExcerpts(self):
+        # Retrieved once per request; expansion and the answer see the same excerpts
+        if self.upload_excerpts is None:
+            chunks = retrieve_chunks(self.upload_documents, self.query)
+            self.upload_excerpts = "".join(
+                f"\n--- {name} (lines {first}-{last}) ---\n{text}\n" for name, first, last, text in chunks
+            )
+            if self.upload_excerpts:
+                self.upload_excerpts = "Relevant excerpts from uploaded files:\n" + self.upload_excerpts
+        return self.upload_excerpts
+
+    def callModel(self, messages, on_chunk=None, cancel_event=None):
+        # With on_chunk, the answer is streamed and each text delta is passed on as it arrives.
+        # cancel_event, if given, stops the call in place of the request's own.
+        cancel_event = cancel_event or self.cancel_event
+        stream = bool(on_chunk)
+        backup = HEDGE_BACKUPS.get(self.model_id) if HEDGE_ENABLED else None
+        # Attachments are not sent the same way to every provider, so never hedge those
+        if backup and not self.uploaded_files:
+            deltas = self.hedgedDeltas(backup, messages, stream)
         else:
-            messages.append({"role": "user", "content": prompt_text})
-
-        if self.model_id in ['gpt-4o', 'gpt-4o-mini', 'o1-mini', 'o1-preview']:
-            comp = self.client.chat.completions.create(
-                model=self.model_id,
-                messages=messages
+            deltas = self.timedDeltas(self.model_id, messages, stream)
+        parts = []
+        for delta in deltas:
+            # A closed tab stops paying for the rest of the answer
+            if cancel_event.is_set():
+                raise Cancelled()
+            parts.append(delta)
+            if on_chunk:
+                on_chunk(delta)
+        return ''.join(parts).strip()
+
+    def latencyKey(self, model_id, stream):
+        # Streaming calls are timed to first token, others to the full answer
+        return (model_id, 'stream' if stream and model_id not in NON_STREAMING_MODELS else 'full')
+
+    def timedDeltas(self, model_id, messages, stream):
+        started = time.monotonic()
+        deltas = self.modelDeltas(model_id, messages, stream)
+        first = next(deltas, '')
+        MODEL_LATENCY.record(self.latencyKey(model_id, stream), time.monotonic() - started)
+        yield first
+        yield from deltas
+
+    def hedgedDeltas(self, backup, messages, stream):
+        # Send a backup request if the primary is slower than its usual high percentile;
+        # whichever model produces output first answers and the other is closed
+        primary = self.model_id
+        race = HedgedRace()
+        latency_key = lambda model_id: self.latencyKey(model_id, stream)
+        make = lambda model_id: (lambda: self.modelDeltas(model_id, messages, stream))
+        race.start(primary, make(primary), latency_key)
+        delay = MODEL_LATENCY.percentile(latency_key(primary), HEDGE_PERCENTILE, HEDGE_DEFAULT_DELAY)
+
+        launched = 1
+        errors = []
+        winner = None
+        timeout = delay
+        while winner is None and len(errors) < launched:
+            try:
+                model_id, first, deltas, error = race.next(timeout=timeout)
+            except queue.Empty:
+                model_id, error = None, None
+            if error is not None:
+                print(f"[DEBUG] {model_id} failed during hedged call: {error}")
+                errors.append(error)
+            elif model_id is not None:
+                winner = (model_id, first, deltas)
+            if winner is None and launched == 1:
+                # Primary is slow or failed: hedge now
+                print(f"[DEBUG] Hedging {primary} with {backup} after {delay:.2f}s.")
+                race.start(backup, make(backup), latency_key)
+                launched = 2
+                timeout = None
+        race.finish()
+        if winner is None:
+            raise errors[0]
+
+        model_id, first, deltas = winner
+        if model_id != primary:
+            print(f"[DEBUG] Hedged request answered by {model_id}.")
+        yield first
+        yield from deltas
+
+    def modelDeltas(self, model_id, messages, stream):
+        # Yields the answer's text deltas; a single delta when not streaming
+        stream = stream and model_id not in NON_STREAMING_MODELS
+        self.stats.add(model_calls=1)
+        if model_id in OPENAI_MODELS:
+            # The usage totals arrive in a final, choice-less chunk
+            extra = {"stream_options": {"include_usage": True}} if stream else {}
+            comp = call_with_retry(
+                'openai', self.client.chat.completions.create,
+                model=model_id,
+                messages=messages,
+                stream=stream,
+                **extra
             )
-            return comp.choices[0].message.content
+            if not stream:
+                self.recordUsage(comp.usage)
+                yield comp.choices[0].message.content
+                return
+            try:
+                for chunk in comp:
+                    if getattr(chunk, 'usage', None):
+                        self.recordUsage(chunk.usage)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        yield delta
+            finally:
+                comp.close()
         else:
-            anthro_resp = self.anthropic_client.completions.create(
-                model=self.model_id,
-                max_tokens_to_sample=1024,
-                prompt=anthropic.HUMAN_PROMPT + prompt_text + anthropic.AI_PROMPT
+            system, turns = to_anthropic_request(messages)
+            params = {"model": model_id, "max_tokens": ANTHROPIC_MAX_TOKENS, "messages": turns}
+            if system:
+                params["system"] = system
+            anthro_resp = call_with_retry(
+                'anthropic', self.anthropic_client.messages.create,
+                stream=stream,
+                **params
             )
-            return anthro_resp.completion.strip()
+            if not stream:
+                log_anthropic_cache(anthro_resp.usage)
+                self.recordUsage(anthro_resp.usage)
+                yield ''.join(b.text for b in anthro_resp.content if b.type == 'text').strip()
+                return
+            try:
+                for event in anthro_resp:
+                    # Input is counted at the start, output from the final (cumulative) delta
+                    if event.type == 'message_start':
+                        log_anthropic_cache(event.message.usage)
+                        self.recordUsage(event.message.usage, completion=False)
+                    elif event.type == 'message_delta':
+                        self.recordUsage(event.usage, prompt=False)
+                    elif event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                        yield event.delta.text
+            finally:
+                anthro_resp.close()
+
+    def recordUsage(self, usage, prompt=True, completion=True):
+        # OpenAI reports prompt/completion tokens; Anthropic input (plus cached input) and output
+        if usage is None:
+            return
+        counts = {}
+        if prompt:
+            counts['prompt_tokens'] = getattr(usage, 'prompt_tokens', None)
+            if counts['prompt_tokens'] is None:
+                counts['prompt_tokens'] = sum(
+                    getattr(usage, name, None) or 0
+                    for name in ('input_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+                )
+        if completion:
+            counts['completion_tokens'] = getattr(usage, 'completion_tokens', None)
+            if counts['completion_tokens'] is None:
+                counts['completion_tokens'] = getattr(usage, 'output_tokens', None)
+        self.stats.add(**counts)
+
+    def getImageResults(self, queries, on_results=None):
+        # For images, each query => next page of 10 images at its cursor
+        queries = [q for q in queries if not self.image_paging.isExhausted(q)]
+        return self.searchEach(queries, self.fetchImagePage, on_results)
+
+    def fetchImagePage(self, query):
+        paging = self.image_paging
+        offset = paging.offset(query)
+        results, next_offset = self.bing_image_page(query, offset)
+        paging.advance(query, next_offset, exhausted=not results)
+        return results
 
-    def getImageResults(self, queries):
-        # For images, each query => 10 images
-        results = []
+    def prefetchNextImages(self, queries):
+        # Small look-ahead buffer in the search cache so image "More" renders instantly
         for q in queries:
-            search_url = "https://api.bing.microsoft.com/v7.0/images/search"
-            headers = {"Ocp-Apim-Subscription-Key": self.bing_api_key}
-            params = {"q": q, "count": 10, "imageType": "photo"}
-            resp = requests.get(search_url, headers=headers, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-            if 'value' in data:
-                for v in data['value']:
-                    results.append({
-                        'thumbnailUrl': v.get('thumbnailUrl', ''),
-                        'contentUrl': v.get('contentUrl', ''),
-                        'hostPageUrl': v.get('hostPageUrl', '')
-                    })
+            offset = self.image_paging.offset(q)
+            for _ in range(IMAGE_PREFETCH_PAGES):
+                if self.image_paging.isExhausted(q):
+                    break
+                try:
+                    results, offset = self.bing_image_page(q, offset)
+                except Exception as e:
+                    print(f"[DEBUG] Image prefetch for '{q}' failed: {e}")
+                    break
+                if not results:
+                    break
+
+    def bing_image_search(self, query, offset=0):
+        results, _ = self.bing_image_page(query, offset)
         return results
 
+    def bing_image_page(self, query, offset=0):
+        search_url = "https://api.bing.microsoft.com/v7.0/images/search"
+        params = {"q": query, "count": IMAGES_PER_PAGE, "imageType": "photo"}
+        if offset:
+            params["offset"] = offset
+        data = self.bing_get(search_url, params)
+        results = []
+        if 'value' in data:
+            for v in data['value']:
+                results.append({
+                    'thumbnailUrl': v.get('thumbnailUrl', ''),
+                    'contentUrl': v.get('contentUrl', ''),
+                    'hostPageUrl': v.get('hostPageUrl', '')
+                })
+        # Bing reports where the next page starts, accounting for results it filtered out
+        next_offset = data.get('nextOffset') or offset + len(data.get('value', []))
+        return results, next_offset
+
+###############################################################################
+# All pipeline runs share one bounded thread pool; queued runs start in priority order
+
+WORKER_THREADS = env_int('WORKER_THREADS', 6)
+PRIORITY_INTERACTIVE = 10
+PRIORITY_MORE = 5
+PRIORITY_SPECULATIVE = 0
+SHUTDOWN_WAIT_MS = 3000
+
+WORKER_POOL = QThreadPool()
+WORKER_POOL.setMaxThreadCount(WORKER_THREADS)
+# Idle pool threads are kept around for bursts instead of being recreated
+WORKER_POOL.setExpiryTimeout(5 * 60 * 1000)
+
+
+class WorkerTask(QRunnable):
+    """ Runs a Worker on a pool thread; its signals still reach the GUI thread queued """
+
+    def __init__(self, worker):
+        super().__init__()
+        self.worker = worker
+        self.setAutoDelete(True)
+
+    def run(self):
+        try:
+            self.worker.run()
+        except RuntimeError:
+            # Swallowed only at exit, when teardown took the Worker's QObject with it; anything else is a real bug
+            if not (QCoreApplication.closingDown() or QCoreApplication.instance() is None):
+                raise
+
+
+def submit_worker(worker, priority=PRIORITY_INTERACTIVE):
+    WORKER_POOL.start(WorkerTask(worker), priority)
+
 ###############################################################################
 class CopyableLabel(QLabel):
     def __init__(self, text='', parent=None):
@@ -255,11 +2872,13 @@ class CopyableLabel(QLabel):
 
 ###############################################################################
 class MessageWidget(QWidget):
-    def __init__(self, sender, message, mode='text'):
+    def __init__(self, sender, message, mode='text', note=None):
         super().__init__()
         self.sender = sender
         self.message = message
         self.mode = mode
+        # Small print under an answer, e.g. what was cut to stay within the latency budget
+        self.note = note
         self.initUI()
 
     def initUI(self):
@@ -282,21 +2901,32 @@ class MessageWidget(QWidget):
                 "QTextBrowser { border: none; background-color: transparent; }"
             )
 
-            html_content = self.processMessage(self.message)
-            self.message_display.setHtml(html_content)
             self.message_display.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Minimum)
             self.message_display.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
             self.message_display.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
             layout.addWidget(self.message_display)
-
-            self.message_display.document().setTextWidth(self.message_display.viewport().width())
-            height = self.message_display.document().size().height()
-            self.message_display.setFixedHeight(int(height) + 10)
-
+            self.render_seq = 0
+            self.renderMessage()
+
+            self.note_label = QLabel()
+            self.note_label.setFont(QFont('Arial', 9))
+            self.note_label.setStyleSheet("QLabel { color: #AAAAAA; }")
+            self.note_label.setWordWrap(True)
+            layout.addWidget(self.note_label)
+            self.setNote(self.note)
+
+            buttons = QHBoxLayout()
+            buttons.addStretch()
+            # Shown for a cached answer
+            self.refresh_button = QPushButton('Refresh')
+            self.refresh_button.setFixedWidth(80)
+            self.refresh_button.hide()
+            buttons.addWidget(self.refresh_button)
             self.copy_button = QPushButton('Copy Response')
             self.copy_button.clicked.connect(self.copyResponse)
             self.copy_button.setFixedWidth(120)
-            layout.addWidget(self.copy_button, alignment=Qt.AlignRight)
+            buttons.addWidget(self.copy_button)
+            layout.addLayout(buttons)
 
         else:
             self.message_display = QLabel(self.message)
@@ -304,11 +2934,52 @@ class MessageWidget(QWidget):
             self.message_display.setWordWrap(True)
             layout.addWidget(self.message_display)
 
+    def updateHeight(self):
+        self.message_display.document().setTextWidth(self.message_display.viewport().width())
+        height = self.message_display.document().size().height()
+        self.message_display.setFixedHeight(int(height) + 10)
+
+    def setMessage(self, message):
+        # Used while an answer streams in
+        self.message = message
+        if isinstance(self.message_display, QTextBrowser):
+            self.renderMessage()
+        else:
+            self.message_display.setText(message)
+
+    def setNote(self, note):
+        self.note = note
+        self.note_label.setText(note or '')
+        self.note_label.setVisible(bool(note))
+
+    def renderMessage(self):
+        self.render_seq += 1
+        if len(self.message) < OFFLOAD_MIN_CHARS:
+            self.applyRender(self.render_seq, self.processMessage(self.message))
+            return
+        if not self.message_display.toPlainText():
+            # Raw text until the rendered HTML comes back
+            self.message_display.setPlainText(self.message)
+            self.updateHeight()
+        run_offloaded(render_markdown, (self.message,), self.applyRender, tag=self.render_seq)
+
+    def applyRender(self, seq, html):
+        # Renders can finish out of order while an answer streams in; keep only the newest
+        if seq != self.render_seq:
+            return
+        self.message_display.setHtml(html)
+        self.updateHeight()
+
     def processMessage(self, message):
-        html = markdown.markdown(message, extensions=['fenced_code', 'tables'])
-        html = re.sub(r'\\\((.*?)\\\)', r'<i>\1</i>', html)
-        html = re.sub(r'\\\[(.*?)\\\]', r'<i>\1</i>', html)
-        return html
+        return render_markdown(message)
+
+    def setRefreshAction(self, action):
+        # One click: the button goes away once used
+        def refresh():
+            self.refresh_button.hide()
+            action()
+        self.refresh_button.clicked.connect(refresh)
+        self.refresh_button.show()
 
     def copyResponse(self):
         clipboard = QApplication.clipboard()
@@ -360,10 +3031,14 @@ class MessageWidget(QWidget):
 
 ###############################################################################
 class ImageWidget(QWidget):
-    def __init__(self, image_url, link_url, parent=None):
+    def __init__(self, image_url, link_url, parent=None, image_data=None, thumbnail=None):
         super().__init__(parent)
         self.image_url = image_url
         self.link_url = link_url
+        # Raw thumbnail bytes, kept so a hibernated tab can be rebuilt offline (b'' = unavailable)
+        self.image_data = image_data
+        # (bytes, QImage) when the worker already loaded it for deduplication
+        self.thumbnail = thumbnail
         self.initUI()
 
     def initUI(self):
@@ -376,17 +3051,19 @@ class ImageWidget(QWidget):
 
         self.image_label = QLabel()
         self.image_label.setAlignment(Qt.AlignCenter)
-        try:
-            resp = requests.get(self.image_url)
-            resp.raise_for_status()
-            pixmap = QPixmap()
-            pixmap.loadFromData(resp.content)
+        if self.thumbnail is not None:
+            self.imageLoaded(None, self.thumbnail)
+            self.thumbnail = None
+        elif self.image_data == b'':
+            self.image_label.setText("Image not available")
+        else:
+            self.image_label.setText("Loading...")
             # Scale to ~300 px wide to ensure we only get 2 images per row
-            self.image_label.setPixmap(
-                pixmap.scaledToWidth(300, Qt.SmoothTransformation)
+            run_offloaded(
+                fetch_thumbnail, (self.image_url, self.image_data, THUMBNAIL_WIDTH),
+                self.imageLoaded, self.imageFailed, executor=ASSET_EXECUTOR,
+                postprocess=lambda result: result[:2]
             )
-        except:
-            self.image_label.setText("Image not available")
         layout.addWidget(self.image_label)
 
         self.link_label = QLabel(f"<a href='{self.link_url}' style='color: #55AAFF;'>View Source</a>")
@@ -394,6 +3071,14 @@ class ImageWidget(QWidget):
         self.link_label.setOpenExternalLinks(True)
         layout.addWidget(self.link_label)
 
+    def imageLoaded(self, _, result):
+        self.image_data, image = result
+        self.image_label.setPixmap(QPixmap.fromImage(image))
+
+    def imageFailed(self, _, error):
+        self.image_data = self.image_data or b''
+        self.image_label.setText("Image not available")
+
     def contextMenuEvent(self, event: QContextMenuEvent):
         menu = QMenu(self)
         download_action = menu.addAction("Download Image")
@@ -412,19 +3097,18 @@ class ImageWidget(QWidget):
         )
         if file_path:
             try:
-                resp = requests.get(self.image_url)
-                resp.raise_for_status()
-                with open(file_path, 'wb') as f:
-                    f.write(resp.content)
+                ASSET_CACHE.saveTo(self.image_url, file_path)
             except Exception as e:
                 from PyQt5.QtWidgets import QMessageBox
                 QMessageBox.critical(self, "Download Error", f"Failed to download image: {str(e)}")
 
 ###############################################################################
 class SourceWidget(QWidget):
-    def __init__(self, source):
+    def __init__(self, source, favicon_data=None):
         super().__init__()
         self.source = source
+        # Raw favicon bytes (b'' = use the default icon), reused when a tab is rebuilt
+        self.favicon_data = favicon_data
         self.initUI()
 
     def initUI(self):
@@ -476,13 +3160,19 @@ class SourceWidget(QWidget):
 
     def getFavicon(self, url):
         try:
-            domain = urlparse(url).netloc
-            fav_url = f"https://www.google.com/s2/favicons?sz=64&domain_url={domain}"
-            r = requests.get(fav_url)
+            if self.favicon_data is None:
+                domain = urlparse(url).netloc
+                if not domain:
+                    # Local corpus files get the default icon
+                    raise ValueError("no host")
+                fav_url = f"https://www.google.com/s2/favicons?sz=64&domain_url={domain}"
+                self.favicon_data = ASSET_CACHE.fetch(fav_url)
             pix = QPixmap()
-            pix.loadFromData(r.content)
+            if not self.favicon_data or not pix.loadFromData(self.favicon_data):
+                raise ValueError("no favicon data")
             return pix
         except:
+            self.favicon_data = self.favicon_data or b''
             return QPixmap(resource_path('assets/default_icon.png'))
 
 ###############################################################################
@@ -564,6 +3254,43 @@ class UploadedFilesWidget(QFrame):
                 w.deleteLater()
         self.setVisible(False)
 
+###############################################################################
+# Tab hibernation
+
+# Background tabs idle this long (seconds) release their result widgets; 0 disables
+HIBERNATE_AFTER = env_float('HIBERNATE_AFTER', 600)
+HIBERNATE_CHECK_MS = 30 * 1000
+
+
+def save_snapshot(state):
+    # Compressed pickle on disk; kept in memory if the temp dir is not writable
+    payload = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+    try:
+        with tempfile.NamedTemporaryFile(prefix='alvely-tab-', suffix='.snap', delete=False) as f:
+            f.write(payload)
+        return ('disk', f.name)
+    except OSError:
+        return ('memory', payload)
+
+
+def load_snapshot(snapshot):
+    where, value = snapshot
+    if where == 'disk':
+        with open(value, 'rb') as f:
+            payload = f.read()
+        discard_snapshot(snapshot)
+    else:
+        payload = value
+    return pickle.loads(zlib.decompress(payload))
+
+
+def discard_snapshot(snapshot):
+    if snapshot and snapshot[0] == 'disk':
+        try:
+            os.remove(snapshot[1])
+        except OSError:
+            pass
+
 ###############################################################################
 class ChatApp(QWidget):
     def __init__(self):
@@ -572,16 +3299,52 @@ class ChatApp(QWidget):
         self.selected_model = 'gpt-4o-mini'
         self.conversation_history = []
         self.uploaded_files = []
+        # Large text/code uploads, chunked and indexed; they stay searchable for the conversation
+        self.upload_documents = []
+        # Uploads still being encoded/rasterized in the process pool; a submit waits for them
+        self.pending_uploads = 0
+        self.upload_generation = 0
+        self.queued_submit = None
         self.bing_api_key = os.getenv("BING_API_KEY", "")
 
         self.source_widgets = []
         self.image_widgets = []
-        self.worker_thread = None
+        # Grid the current image request streams into
+        self.image_grid = None
+        # Workers keep prefetching after their results are shown, so a new request can
+        # start while an older one is still running; hold them until they finish
+        self.running_workers = []
         self.image_offset = 0
 
+        # Speculative prefetch while typing (opt-in)
+        self.speculative_enabled = SPECULATIVE_DEFAULT
+        self.speculations = []
+        self.speculation_timer = QTimer()
+        self.speculation_timer.setSingleShot(True)
+        self.speculation_timer.setInterval(SPECULATION_DELAY_MS)
+        self.speculation_timer.timeout.connect(self.startSpeculation)
+
         # Track duplicates
-        self.fetched_urls = set()
-        self.fetched_image_urls = set()
+        self.fetched_urls = ResultDeduper()
+        self.fetched_image_urls = ResultDeduper()
+        self.image_hashes = ImageHashIndex()
+        # Offset cursors for "More"
+        self.link_paging = PagingState()
+        self.image_paging = PagingState()
+
+        # Progressive answer rendering
+        self.answer_worker = None
+        self.answer_widget = None
+        self.status_label = None
+        self.streaming_text = ''
+        self.stream_timer = QTimer()
+        self.stream_timer.setSingleShot(True)
+        self.stream_timer.setInterval(100)
+        self.stream_timer.timeout.connect(self.flushAnswer)
+
+        # Hibernation: compact snapshot of the results while the widgets are released
+        self.snapshot = None
+        self.last_active = time.monotonic()
 
         self.initUI()
         self.setupClients()
@@ -646,6 +3409,12 @@ class ChatApp(QWidget):
             "Smarter (claude-3-5-sonnet-latest)",
             "Smartest (o1-preview)"
         ])
+        for i, model_id in enumerate(MODEL_TIERS):
+            self.model_dropdown.setItemData(
+                i, f"Aims to start answering within {LATENCY_BUDGETS[model_id]:g}s; "
+                "query expansion and searches are cut short to keep to it",
+                Qt.ToolTipRole
+            )
         self.model_dropdown.currentIndexChanged.connect(self.changeModel)
         top_layout.addWidget(self.model_dropdown, 0, 0, Qt.AlignLeft)
 
@@ -725,6 +3494,7 @@ class ChatApp(QWidget):
         self.init_search_bar = QLineEdit()
         self.init_search_bar.setPlaceholderText('Type your query here...')
         self.init_search_bar.returnPressed.connect(self.onFirstSubmit)
+        self.init_search_bar.textChanged.connect(self.onQueryEdited)
         self.init_search_bar.setFixedWidth(400)
         self.init_search_bar.setFixedHeight(40)
         self.init_search_bar.setAlignment(Qt.AlignLeft)
@@ -776,6 +3546,7 @@ class ChatApp(QWidget):
         self.input_field = QLineEdit()
         self.input_field.setPlaceholderText('Type your query here...')
         self.input_field.returnPressed.connect(self.onSubmit)
+        self.input_field.textChanged.connect(self.onQueryEdited)
         self.input_field.setFixedHeight(40)
         self.input_field.setFont(QFont('Arial', 14))
         self.input_field.setStyleSheet("""
@@ -827,10 +3598,22 @@ class ChatApp(QWidget):
     def setupClients(self):
         print("[DEBUG] Setting up OpenAI and Anthropc clients.")
         self.openai_api_key = os.getenv("OPENAI_API_KEY", "")
-        self.client = OpenAI(api_key=self.openai_api_key)
+        # Retries are handled by call_with_retry so they share the process-wide rate limits
+        # *_BASE_URL lets the app run against a local stub server
+        self.client = OpenAI(
+            api_key=self.openai_api_key,
+            base_url=os.getenv("OPENAI_BASE_URL") or None,
+            max_retries=0,
+            http_client=sdk_http_client(openai)
+        )
 
         self.anthropic_api_key = os.getenv("ANTHROPIC_API_KEY", "")
-        self.anthropic_client = anthropic.Anthropic(api_key=self.anthropic_api_key)
+        self.anthropic_client = anthropic.Anthropic(
+            api_key=self.anthropic_api_key,
+            base_url=os.getenv("ANTHROPIC_BASE_URL") or None,
+            max_retries=0,
+            http_client=sdk_http_client(anthropic)
+        )
 
     def getModeButtonStyle(self, mode):
         if self.current_mode == mode:
@@ -893,12 +3676,15 @@ class ChatApp(QWidget):
     def clearUploads(self):
         print("[DEBUG] Clearing uploaded files.")
         self.uploaded_files.clear()
+        self.upload_documents.clear()
+        self.upload_generation += 1
         self.init_uploaded_files_widget.clearFiles()
         self.chat_uploaded_files_widget.clearFiles()
         self.clearResults()
 
     def clearResults(self):
         print("[DEBUG] Clearing chat results.")
+        self.endAnswer()
         while self.scroll_layout.count():
             item = self.scroll_layout.takeAt(0)
             if item:
@@ -907,10 +3693,14 @@ class ChatApp(QWidget):
                     w.deleteLater()
         self.source_widgets.clear()
         self.image_widgets.clear()
+        self.image_grid = None
         self.image_offset = 0
         # Clear duplicates
         self.fetched_urls.clear()
         self.fetched_image_urls.clear()
+        self.image_hashes.clear()
+        self.link_paging = PagingState()
+        self.image_paging = PagingState()
 
     def rotateLoadingImage(self):
         self.rotation_angle = (self.rotation_angle + 10) % 360
@@ -968,34 +3758,26 @@ class ChatApp(QWidget):
         query = self.init_search_bar.text().strip()
         if not query:
             return
+        if self.pending_uploads:
+            # Sent as soon as the uploads finish processing
+            self.queued_submit = self.onFirstSubmit
+            return
         self.init_search_bar.clear()
         self.stack.setCurrentWidget(self.chat_page)
-
-        self.conversation_history.append({'role': 'user', 'content': query})
-        user_msg = MessageWidget('User', query, mode=self.current_mode)
-        self.scroll_layout.addWidget(user_msg)
-        self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
-
-        for w in self.source_widgets:
-            self.scroll_layout.removeWidget(w)
-            w.deleteLater()
-        self.source_widgets.clear()
-
-        for w in self.image_widgets:
-            self.scroll_layout.removeWidget(w)
-            w.deleteLater()
-        self.image_widgets.clear()
-
-        self.init_uploaded_files_widget.clearFiles()
-        self.chat_uploaded_files_widget.clearFiles()
-        self.uploaded_files.clear()
-        self.startWorker(query)
+        self.askQuery(query)
 
     def onSubmit(self):
         query = self.input_field.text().strip()
         if not query:
             return
+        if self.pending_uploads:
+            # Sent as soon as the uploads finish processing
+            self.queued_submit = self.onSubmit
+            return
         self.input_field.clear()
+        self.askQuery(query)
+
+    def askQuery(self, query, use_answer_cache=True):
         self.conversation_history.append({'role': 'user', 'content': query})
         user_msg = MessageWidget('User', query, mode=self.current_mode)
         self.scroll_layout.addWidget(user_msg)
@@ -1013,13 +3795,89 @@ class ChatApp(QWidget):
 
         self.init_uploaded_files_widget.clearFiles()
         self.chat_uploaded_files_widget.clearFiles()
+        self.startWorker(query, use_answer_cache=use_answer_cache)
+        # Attachments, indexed ones included, go with this question only, like their chips
         self.uploaded_files.clear()
-        self.startWorker(query)
+        self.upload_documents.clear()
+        self.upload_generation += 1
+
+    def onQueryEdited(self, text):
+        # An emptied field usually means the query was just submitted
+        if not self.speculative_enabled or not text.strip():
+            return
+        # Anything already speculating on older text is now obsolete
+        self.cancelSpeculations(keep_query=text.strip())
+        self.speculation_timer.start()
+
+    def currentQueryText(self):
+        if self.stack.currentWidget() == self.init_page:
+            return self.init_search_bar.text().strip()
+        return self.input_field.text().strip()
+
+    def startSpeculation(self):
+        query = self.currentQueryText()
+        attached = self.uploaded_files or self.upload_documents
+        if not self.speculative_enabled or len(query) < SPECULATION_MIN_CHARS or attached:
+            return
+        if any(w.query == query for w in self.speculations):
+            return
+        # Cost estimate: one expansion call plus one search per expanded query
+        cost = 1 + MAX_RELATED_QUERIES.get(self.selected_model, DEFAULT_MAX_RELATED_QUERIES)
+        if not SPECULATION_BUDGET.tryAcquire(cost):
+            print("[DEBUG] Speculation budget exhausted, skipping prefetch.")
+            return
+        print(f"[DEBUG] Speculatively prefetching '{query}'.")
+        worker = Worker(
+            query=query,
+            conversation_history=self.conversation_history,
+            client=self.client,
+            anthropic_client=self.anthropic_client,
+            bing_api_key=self.bing_api_key,
+            uploaded_files=[],
+            mode=self.current_mode,
+            model_id=self.selected_model,
+            speculative=True
+        )
+        worker.finished.connect(lambda w=worker: self.speculationFinished(w))
+        self.speculations.append(worker)
+        submit_worker(worker, PRIORITY_SPECULATIVE)
+
+    def speculationFinished(self, worker):
+        if worker in self.speculations:
+            self.speculations.remove(worker)
+
+    def cancelSpeculations(self, keep_query=None):
+        # Cancelled runs still queued in the pool return as soon as they start
+        for worker in self.speculations:
+            if worker.query != keep_query:
+                worker.cancel_event.set()
+
+    def toggleSpeculation(self):
+        self.speculative_enabled = not self.speculative_enabled
+        self.speculation_button.setText(self.speculationButtonText())
+        if not self.speculative_enabled:
+            self.speculation_timer.stop()
+            self.cancelSpeculations()
+
+    def speculationButtonText(self):
+        return f"Prefetch: {'On' if self.speculative_enabled else 'Off'}"
+
+    def refreshAnswer(self, query):
+        # Asked again as a new turn, past the cache; its sources may be shown again
+        self.fetched_urls.clear()
+        self.askQuery(query, use_answer_cache=False)
 
-    def startWorker(self, query):
+    def startWorker(self, query, more=False, use_answer_cache=True):
         print(f"[DEBUG] startWorker called with query='{query}', mode='{self.current_mode}', model='{self.selected_model}'.")
+        if self.link_paging.query != query:
+            # Cursors belong to one typed query
+            self.link_paging = PagingState(query)
+        if self.image_paging.query != query:
+            self.image_paging = PagingState(query)
+        # A speculation for this exact query keeps warming the caches we are about to read
+        self.speculation_timer.stop()
+        self.cancelSpeculations(keep_query=query)
         self.showLoading()
-        self.worker_thread = QThread()
         self.worker = Worker(
             query=query,
             conversation_history=self.conversation_history,
@@ -1027,114 +3885,238 @@ class ChatApp(QWidget):
             anthropic_client=self.anthropic_client,
             bing_api_key=self.bing_api_key,
             uploaded_files=self.uploaded_files,
+            upload_documents=self.upload_documents,
             mode=self.current_mode,
             model_id=self.selected_model,
             fetched_urls=self.fetched_urls,
-            fetched_image_urls=self.fetched_image_urls
+            fetched_image_urls=self.fetched_image_urls,
+            image_hashes=self.image_hashes,
+            use_answer_cache=use_answer_cache,
+            more=more,
+            link_paging=self.link_paging,
+            image_paging=self.image_paging,
+            submitted_at=time.monotonic()
         )
-        self.worker.moveToThread(self.worker_thread)
-        self.worker_thread.started.connect(self.worker.run)
-
-        self.worker.result_ready.connect(self.handleResult)
-        self.worker.sources_ready.connect(self.displaySources)
-        self.worker.images_ready.connect(self.displayImages)
-        self.worker.error_occurred.connect(self.handleError)
 
-        self.worker.finished.connect(self.worker_thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.worker_thread.finished.connect(self.worker_thread.deleteLater)
-        self.worker_thread.start()
-
-    def handleResult(self, result):
+        if self.current_mode == 'text' and not more:
+            self.beginAnswer(self.worker)
+        elif self.current_mode == 'image':
+            # Each image request streams into a fresh grid
+            self.image_grid = None
+
+        # The worker may already be deleted when these queued calls land, so it is
+        # bound into each slot instead of relying on sender()
+        worker = self.worker
+        worker.queries_ready.connect(lambda queries, w=worker: self.handleQueries(queries, w))
+        worker.answer_chunk.connect(lambda chunk, w=worker: self.handleAnswerChunk(chunk, w))
+        worker.result_ready.connect(lambda result, w=worker: self.handleResult(result, w))
+        worker.sources_ready.connect(lambda results, w=worker: self.displaySources(results, w))
+        worker.images_ready.connect(lambda results, w=worker: self.displayImages(results, w))
+        worker.error_occurred.connect(lambda message, w=worker: self.handleError(message, w))
+
+        worker.finished.connect(lambda w=worker: self.workerFinished(w))
+        self.running_workers.append(worker)
+        submit_worker(worker, PRIORITY_MORE if more else PRIORITY_INTERACTIVE)
+
+    def beginAnswer(self, worker):
+        # Reserve the answer's place: sources are appended below it as they arrive,
+        # so the final layout is user message, answer, More, sources
+        if self.answer_worker is not None:
+            # Superseded by this question; its answer would never be shown
+            self.answer_worker.cancel_event.set()
+        self.endAnswer()
+        self.answer_worker = worker
+        self.streaming_text = ''
+        self.status_label = QLabel('Expanding query...')
+        self.status_label.setFont(QFont('Arial', 10))
+        self.status_label.setStyleSheet("QLabel { color: #AAAAAA; }")
+        self.status_label.setWordWrap(True)
+        self.scroll_layout.addWidget(self.status_label)
+
+    def endAnswer(self):
+        self.stream_timer.stop()
+        if self.status_label:
+            self.scroll_layout.removeWidget(self.status_label)
+            self.status_label.deleteLater()
+        self.status_label = None
+        self.answer_worker = None
+        self.answer_widget = None
+        self.streaming_text = ''
+
+    def answerIndex(self):
+        if self.status_label:
+            return self.scroll_layout.indexOf(self.status_label)
+        return self.scroll_layout.count()
+
+    def handleQueries(self, queries, worker):
+        if worker is self.answer_worker and self.status_label:
+            self.status_label.setText('Searching: ' + ' · '.join(queries))
+
+    def handleAnswerChunk(self, chunk, worker):
+        if worker is not self.answer_worker:
+            return
+        self.streaming_text += chunk
+        if self.answer_widget is None:
+            self.hideLoading()
+            if self.status_label:
+                self.status_label.setText('Writing answer...')
+            self.answer_widget = MessageWidget('Assistant', '', mode=self.current_mode)
+            self.scroll_layout.insertWidget(self.answerIndex(), self.answer_widget)
+        # Re-rendering markdown per token is wasteful, so batch updates
+        if not self.stream_timer.isActive():
+            self.stream_timer.start()
+
+    def flushAnswer(self):
+        if self.answer_widget:
+            self.answer_widget.setMessage(self.streaming_text)
+
+    def handleResult(self, result, worker=None):
         print("[DEBUG] handleResult called.")
+        if worker is not None and worker is not self.answer_worker:
+            # Queued before its worker was superseded; the newer answer owns the status and spinner
+            print(f"[DEBUG] Dropping result of superseded query '{worker.query}'.")
+            return
         self.hideLoading()
         self.conversation_history.append({'role': 'assistant', 'content': result})
-        msg = MessageWidget('Assistant', result, mode=self.current_mode)
-        self.scroll_layout.addWidget(msg)
-        self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
+        notes = []
+        if worker and worker.cached_answer:
+            notes.append(f"Cached answer from {format_age(time.time() - worker.cached_answer['stored_at'])}.")
+        if worker and worker.budget_notes:
+            notes.append(budget_note(worker.model_id, worker.budget_notes))
+        note = ' '.join(notes) or None
+        if worker is self.answer_worker and self.answer_widget:
+            msg = self.answer_widget
+            msg.setMessage(result)
+            msg.setNote(note)
+        else:
+            msg = MessageWidget('Assistant', result, mode=self.current_mode, note=note)
+            self.scroll_layout.insertWidget(self.answerIndex(), msg)
+        if worker and worker.cached_answer:
+            msg.setRefreshAction(lambda query=worker.query: self.refreshAnswer(query))
+        self.endAnswer()
 
         if self.current_mode == 'text':
-            more_button = QPushButton('More')
-            more_button.setFixedWidth(80)
-            more_button.clicked.connect(self.loadMoreResults)
-            self.scroll_layout.addWidget(more_button, alignment=Qt.AlignCenter)
+            more_button = self.createMoreButton('text')
+            self.scroll_layout.insertWidget(self.scroll_layout.indexOf(msg) + 1, more_button, alignment=Qt.AlignCenter)
+
+    def createMoreButton(self, kind):
+        more_button = QPushButton('More')
+        more_button.setFixedWidth(80)
+        more_button.setProperty('moreKind', kind)
+        more_button.clicked.connect(self.loadMoreResults if kind == 'text' else self.loadMoreImages)
+        return more_button
+
+    def createImageGrid(self):
+        # We'll build a QGridLayout: 2 columns, many rows
+        grid_widget = QWidget()
+        grid_widget.setProperty('imageGrid', True)
+        grid_layout = QGridLayout(grid_widget)
+        grid_layout.setContentsMargins(0, 0, 0, 0)
+        grid_layout.setSpacing(10)
+        self.scroll_layout.addWidget(grid_widget, alignment=Qt.AlignLeft)
+        return grid_layout
+
+    def addImageToGrid(self, grid_layout, image_widget):
+        self.image_widgets.append(image_widget)
+        idx = grid_layout.count()
+        grid_layout.addWidget(image_widget, idx // 2, idx % 2, Qt.AlignCenter)
+
+    def workerFinished(self, worker):
+        if worker in self.running_workers:
+            self.running_workers.remove(worker)
+        if worker is self.answer_worker:
+            self.endAnswer()
 
-    def handleError(self, error_message):
+    def handleError(self, error_message, worker=None):
         print("[DEBUG] handleError called with:", error_message)
+        if worker is self.answer_worker:
+            self.endAnswer()
         self.hideLoading()
         self.showError(error_message)
 
-    def displaySources(self, search_results):
+    def displaySources(self, search_results, worker=None):
         # Called after we fetch text links
+        if worker is not None and worker is not self.worker:
+            # Still queued from an older request
+            return
         print("[DEBUG] displaySources called with", len(search_results), "results.")
         self.hideLoading()
         for item in search_results:
             sw = SourceWidget(item)
-            self.scroll_layout.addWidget(sw, alignment=Qt.AlignLeft)
-            self.source_widgets.append(sw)
+            # Batches arrive per query and backend as they finish; keep the panel best score first
+            pos = self.sourcePosition(item.get('score'))
+            if pos < len(self.source_widgets):
+                index = self.scroll_layout.indexOf(self.source_widgets[pos])
+            else:
+                index = self.scroll_layout.count()
+            self.scroll_layout.insertWidget(index, sw, alignment=Qt.AlignLeft)
+            self.source_widgets.insert(pos, sw)
         self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
 
-    def displayImages(self, image_results):
-        # Show images in a 2-column grid
+    def sourcePosition(self, score):
+        # Before the first shown source with a lower score; unscored ones ("More" pages) go last
+        if score is not None:
+            for pos, sw in enumerate(self.source_widgets):
+                other = sw.source.get('score')
+                if other is None or other < score:
+                    return pos
+        return len(self.source_widgets)
+
+    def displayImages(self, image_results, worker=None):
+        # Show images in a 2-column grid; called once per query batch as searches return
+        if worker is not None and worker is not self.worker:
+            return
         print("[DEBUG] displayImages called with", len(image_results), "images.")
         self.hideLoading()
 
-        # We'll build a QGridLayout: 2 columns, many rows
-        grid_widget = QWidget()
-        grid_layout = QGridLayout(grid_widget)
-        grid_layout.setContentsMargins(0, 0, 0, 0)
-        grid_layout.setSpacing(10)
-
-        row = 0
-        col = 0
-        for idx, img in enumerate(image_results):
-            iw = ImageWidget(img['thumbnailUrl'], img['hostPageUrl'])
-            self.image_widgets.append(iw)
+        first_batch = self.image_grid is None
+        if first_batch:
+            self.image_grid = self.createImageGrid()
+            self.scroll_layout.addWidget(self.createMoreButton('image'), alignment=Qt.AlignCenter)
 
-            grid_layout.addWidget(iw, row, col, Qt.AlignCenter)
-            col += 1
-            if col >= 2:
-                row += 1
-                col = 0
-
-        self.scroll_layout.addWidget(grid_widget, alignment=Qt.AlignLeft)
-
-        more_button = QPushButton('More')
-        more_button.setFixedWidth(80)
-        more_button.clicked.connect(self.loadMoreImages)
-        self.scroll_layout.addWidget(more_button, alignment=Qt.AlignCenter)
+        for img in image_results:
+            self.addImageToGrid(
+                self.image_grid,
+                ImageWidget(img['thumbnailUrl'], img['hostPageUrl'], thumbnail=img.get('thumbnail'))
+            )
 
         self.image_offset += len(image_results)
-        self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
+        if first_batch:
+            self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
 
     def loadMoreResults(self):
         print("[DEBUG] loadMoreResults called.")
-        # Single typed query only, skip duplicates
+        # Single typed query only, next page by offset, skip duplicates
         user_query = None
         for msg in reversed(self.conversation_history):
             if msg['role'] == 'user':
                 user_query = msg['content']
                 break
         if user_query:
-            self.startWorker(user_query)
+            self.startWorker(user_query, more=True)
 
     def loadMoreImages(self):
         print("[DEBUG] loadMoreImages called.")
-        # AI approach each time, skip duplicates
+        # Reuse the expanded queries and their cursors, skip duplicates
         user_query = None
         for msg in reversed(self.conversation_history):
             if msg['role'] == 'user':
                 user_query = msg['content']
                 break
         if user_query:
-            self.startWorker(user_query)
+            self.startWorker(user_query, more=True)
 
     def reloadApp(self):
         print("[DEBUG] reloadApp called.")
         self.conversation_history.clear()
         self.uploaded_files.clear()
+        self.upload_documents.clear()
         self.fetched_urls.clear()
         self.fetched_image_urls.clear()
+        self.image_hashes.clear()
+        self.link_paging = PagingState()
+        self.image_paging = PagingState()
+        self.endAnswer()
 
         while self.scroll_layout.count():
             item = self.scroll_layout.takeAt(0)
@@ -1144,6 +4126,7 @@ class ChatApp(QWidget):
                     w.deleteLater()
         self.source_widgets.clear()
         self.image_widgets.clear()
+        self.image_grid = None
         self.image_offset = 0
 
         self.input_field.clear()
@@ -1166,6 +4149,8 @@ class ChatApp(QWidget):
                 self.createSettingsPanel()
             self.settings_panel.raise_()
             self.settings_panel.show()
+            self.refreshTelemetry()
+            self.stats_timer.start()
 
     def createSettingsPanel(self):
         self.settings_panel = QFrame(self)
@@ -1189,8 +4174,60 @@ class ChatApp(QWidget):
         find_button.clicked.connect(self.showFindDialog)
         self.settings_panel.layout().addWidget(find_button)
 
+        self.speculation_button = QPushButton(self.speculationButtonText())
+        self.speculation_button.clicked.connect(self.toggleSpeculation)
+        self.settings_panel.layout().addWidget(self.speculation_button)
+
+        stats_title = QLabel('Performance')
+        stats_title.setFont(QFont('Arial', 10, QFont.Bold))
+        self.settings_panel.layout().addWidget(stats_title)
+
+        self.stats_label = QLabel()
+        self.stats_label.setFont(QFont('Arial', 9))
+        self.stats_label.setStyleSheet("QLabel { color: #CCCCCC; }")
+        self.stats_label.setWordWrap(True)
+        self.stats_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.settings_panel.layout().addWidget(self.stats_label)
+
+        export_button = QPushButton('Export Stats')
+        export_button.clicked.connect(self.exportTelemetry)
+        self.settings_panel.layout().addWidget(export_button)
+
+        # Kept current only while the panel is open
+        self.stats_timer = QTimer(self.settings_panel)
+        self.stats_timer.setInterval(2000)
+        self.stats_timer.timeout.connect(self.refreshTelemetry)
+
         self.settings_panel.hide()
 
+    def refreshTelemetry(self):
+        if not self.settings_panel.isVisible():
+            self.stats_timer.stop()
+            return
+        text = TELEMETRY.summary()
+        if WATCHDOG is not None:
+            text += "\n" + WATCHDOG.summary()
+        self.stats_label.setText(text)
+
+    def exportTelemetry(self):
+        options = QFileDialog.Options()
+        file_path, selected = QFileDialog.getSaveFileName(
+            self,
+            "Export Stats",
+            "alvely-stats.csv",
+            "CSV Files (*.csv);;JSON Lines (*.jsonl)",
+            options=options
+        )
+        if not file_path:
+            return
+        if selected.startswith('JSON') and not file_path.lower().endswith('.jsonl'):
+            file_path += '.jsonl'
+        try:
+            count = TELEMETRY.export(file_path)
+            print(f"[DEBUG] Exported {count} request records to {file_path}.")
+        except Exception as e:
+            self.showError(f"Failed to export stats: {str(e)}")
+
     def resizeEvent(self, event):
         super().resizeEvent(event)
         if self.settings_panel:
@@ -1265,7 +4302,7 @@ class ChatApp(QWidget):
 
     def uploadFiles(self):
         print("[DEBUG] uploadFiles called.")
-        if self.selected_model not in ['gpt-4o', 'gpt-4o-mini']:
+        if self.selected_model not in VISION_MODELS:
             file_filter = (
                 "Text/Code Files (*.txt *.py *.js);;"
                 "All Files (*.txt *.py *.js)"
@@ -1294,48 +4331,32 @@ class ChatApp(QWidget):
             ext = os.path.splitext(file_path)[1].lower()
             file_name = os.path.basename(file_path)
 
-            if self.selected_model not in ['gpt-4o', 'gpt-4o-mini']:
+            if self.selected_model not in VISION_MODELS:
                 if ext in ['.png', '.jpg', '.jpeg', '.bmp', '.gif', '.pdf']:
                     self.showError("Selected model does not support image/PDF uploads.")
                     continue
 
             if ext in ['.png', '.jpg', '.jpeg', '.bmp']:
-                try:
-                    encoded = self.encode_image(file_path)
-                    self.uploaded_files.append({'type': 'image', 'data': encoded, 'name': file_name})
-                    self.addFileToUI('image', file_name)
-                except Exception as e:
-                    self.showError(f"Failed to process image {file_name}: {str(e)}")
+                self.startUpload(encode_file_job, file_path, file_name, 'image')
 
             elif ext in ['.txt', '.py', '.js']:
+                ftype = 'text' if ext == '.txt' else 'code'
                 try:
+                    if os.path.getsize(file_path) > UPLOAD_INLINE_BYTES:
+                        self.startIndexing(file_path, file_name, ftype)
+                        continue
                     with open(file_path, 'r', encoding='utf-8') as f:
                         content = f.read()
-                    ftype = 'text' if ext == '.txt' else 'code'
                     self.uploaded_files.append({'type': ftype, 'data': content, 'name': file_name})
                     self.addFileToUI(ftype, file_name)
                 except Exception as e:
                     self.showError(f"Failed to read file {file_name}: {str(e)}")
 
             elif ext == '.pdf':
-                if self.selected_model not in ['gpt-4o', 'gpt-4o-mini']:
+                if self.selected_model not in VISION_MODELS:
                     self.showError("Selected model does not support image/PDF uploads.")
                     continue
-                try:
-                    imgs = convert_from_path(file_path)
-                    for idx, im in enumerate(imgs):
-                        tmp_path = f"{file_path}_page_{idx+1}.png"
-                        im.save(tmp_path, 'PNG')
-                        encoded = self.encode_image(tmp_path)
-                        self.uploaded_files.append({
-                            'type': 'image',
-                            'data': encoded,
-                            'name': f"{file_name}_page_{idx+1}.png"
-                        })
-                        self.addFileToUI('image', f"{file_name}_page_{idx+1}.png")
-                        os.remove(tmp_path)
-                except Exception as e:
-                    self.showError(f"Failed to process PDF {file_name}: {str(e)}")
+                self.startUpload(rasterize_pdf_job, file_path, file_name, 'pdf')
             else:
                 self.showError(f"Unsupported file type: {ext}")
 
@@ -1345,12 +4366,142 @@ class ChatApp(QWidget):
         else:
             self.uploaded_files_widgets['chat'].addFile(file_type, file_name)
 
-    def encode_image(self, path):
-        with open(path, 'rb') as f:
-            return base64.b64encode(f.read()).decode('utf-8')
+    def startUpload(self, job, file_path, file_name, kind):
+        if kind == 'pdf':
+            postprocess = lambda pages: [unpack_bytes(p).decode('ascii') for p in pages]
+        else:
+            postprocess = lambda data: unpack_bytes(data).decode('ascii')
+        self.pending_uploads += 1
+        run_offloaded(
+            job, (file_path,), self.uploadProcessed, self.uploadFailed,
+            tag=(self.upload_generation, kind, file_name), postprocess=postprocess
+        )
+
+    def startIndexing(self, file_path, file_name, ftype):
+        self.pending_uploads += 1
+        run_offloaded(
+            index_upload_job, (file_path, file_name, ftype == 'code'), self.uploadIndexed, self.uploadFailed,
+            tag=(self.upload_generation, ftype, file_name)
+        )
+
+    def uploadIndexed(self, tag, document):
+        generation, ftype, file_name = tag
+        self.pending_uploads -= 1
+        if generation == self.upload_generation:
+            print(f"[DEBUG] Indexed {file_name} into {len(document.chunks)} chunks.")
+            self.upload_documents.append(document)
+            self.addFileToUI(ftype, file_name)
+        self.uploadSettled()
+
+    def uploadProcessed(self, tag, result):
+        generation, kind, file_name = tag
+        self.pending_uploads -= 1
+        # Uploads cleared (e.g. by a model switch) while this one was processing are dropped
+        if generation == self.upload_generation:
+            if kind == 'pdf':
+                for idx, encoded in enumerate(result):
+                    page_name = f"{file_name}_page_{idx+1}.png"
+                    self.uploaded_files.append({'type': 'image', 'data': encoded, 'name': page_name})
+                    self.addFileToUI('image', page_name)
+            else:
+                self.uploaded_files.append({'type': 'image', 'data': result, 'name': file_name})
+                self.addFileToUI('image', file_name)
+        self.uploadSettled()
+
+    def uploadFailed(self, tag, error):
+        generation, kind, file_name = tag
+        self.pending_uploads -= 1
+        if generation == self.upload_generation:
+            what = {'pdf': "PDF", 'image': "image"}.get(kind, "file")
+            self.showError(f"Failed to process {what} {file_name}: {error}")
+        self.uploadSettled()
+
+    def uploadSettled(self):
+        if not self.pending_uploads and self.queued_submit:
+            submit, self.queued_submit = self.queued_submit, None
+            submit()
+
+    def canHibernate(self):
+        busy = self.running_workers or self.answer_worker is not None or self.pending_uploads
+        return self.snapshot is None and not busy and self.stack.currentWidget() == self.chat_page
+
+    def hibernate(self):
+        # Serialize what the results area shows, then release its widgets and pixmaps
+        print("[DEBUG] Hibernating tab.")
+        entries = []
+        favicons = {}
+        for i in range(self.scroll_layout.count()):
+            w = self.scroll_layout.itemAt(i).widget()
+            if isinstance(w, MessageWidget):
+                entries.append(('message', w.sender, w.message, w.mode, w.note))
+            elif isinstance(w, SourceWidget):
+                entries.append(('source', w.source))
+                favicons[urlparse(w.source['url']).netloc] = w.favicon_data
+            elif isinstance(w, QPushButton) and w.property('moreKind'):
+                entries.append(('more', w.property('moreKind')))
+            elif w is not None and w.property('imageGrid'):
+                grid = w.layout()
+                images = []
+                for j in range(grid.count()):
+                    iw = grid.itemAt(j).widget()
+                    if isinstance(iw, ImageWidget):
+                        images.append((iw.image_url, iw.link_url, iw.image_data))
+                entries.append(('images', images))
+        self.snapshot = save_snapshot({
+            'entries': entries,
+            'favicons': favicons,
+            'scroll': self.scroll_area.verticalScrollBar().value()
+        })
+
+        while self.scroll_layout.count():
+            item = self.scroll_layout.takeAt(0)
+            if item and item.widget():
+                item.widget().deleteLater()
+        self.source_widgets.clear()
+        self.image_widgets.clear()
+        self.image_grid = None
+
+    def wake(self):
+        # Rebuild the results area from the snapshot, without any network calls
+        if self.snapshot is None:
+            return
+        print("[DEBUG] Waking hibernated tab.")
+        state = load_snapshot(self.snapshot)
+        self.snapshot = None
+        favicons = state['favicons']
+        for entry in state['entries']:
+            kind = entry[0]
+            if kind == 'message':
+                _, sender, message, mode, note = entry
+                self.scroll_layout.addWidget(MessageWidget(sender, message, mode=mode, note=note))
+            elif kind == 'source':
+                source = entry[1]
+                sw = SourceWidget(source, favicon_data=favicons.get(urlparse(source['url']).netloc))
+                self.scroll_layout.addWidget(sw, alignment=Qt.AlignLeft)
+                self.source_widgets.append(sw)
+            elif kind == 'more':
+                self.scroll_layout.addWidget(self.createMoreButton(entry[1]), alignment=Qt.AlignCenter)
+            elif kind == 'images':
+                grid = self.createImageGrid()
+                for image_url, link_url, image_data in entry[1]:
+                    self.addImageToGrid(grid, ImageWidget(image_url, link_url, image_data=image_data))
+        scroll = state['scroll']
+        QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(scroll))
+
+    def discardSnapshot(self):
+        discard_snapshot(self.snapshot)
+        self.snapshot = None
+
+    def cancelWorkers(self):
+        self.speculation_timer.stop()
+        self.cancelSpeculations()
+        for worker in self.running_workers:
+            worker.cancel_event.set()
 
     def closeEvent(self, event):
         print("[DEBUG] closeEvent called.")
+        self.cancelWorkers()
+        self.discardSnapshot()
         event.accept()
 
 ###############################################################################
@@ -1401,8 +4552,15 @@ class MainWindow(QMainWindow):
         self.tabs.setCornerWidget(new_tab_btn, Qt.TopRightCorner)
 
         self.setCentralWidget(self.tabs)
+        self.current_tab = None
+        self.tabs.currentChanged.connect(self.tabChanged)
         self.addTab()
 
+        self.hibernate_timer = QTimer(self)
+        self.hibernate_timer.timeout.connect(self.hibernateIdleTabs)
+        if HIBERNATE_AFTER > 0:
+            self.hibernate_timer.start(HIBERNATE_CHECK_MS)
+
     def addTab(self):
         tab = ChatApp()
         index = self.tabs.addTab(tab, f'Tab {self.tabs.count() + 1}')
@@ -1412,12 +4570,56 @@ class MainWindow(QMainWindow):
         widget = self.tabs.widget(index)
         self.tabs.removeTab(index)
         if widget:
+            if widget is self.current_tab:
+                self.current_tab = None
+            widget.cancelWorkers()
+            widget.discardSnapshot()
             widget.deleteLater()
         if self.tabs.count() == 0:
             self.close()
 
+    def tabChanged(self, index):
+        now = time.monotonic()
+        if self.current_tab is not None:
+            self.current_tab.last_active = now
+        tab = self.tabs.widget(index)
+        if tab:
+            tab.wake()
+            tab.last_active = now
+        self.current_tab = tab
+
+    def hibernateIdleTabs(self):
+        now = time.monotonic()
+        current = self.tabs.currentWidget()
+        for i in range(self.tabs.count()):
+            tab = self.tabs.widget(i)
+            if tab is not current and now - tab.last_active >= HIBERNATE_AFTER and tab.canHibernate():
+                tab.hibernate()
+
+    def closeEvent(self, event):
+        for i in range(self.tabs.count()):
+            self.tabs.widget(i).cancelWorkers()
+            self.tabs.widget(i).discardSnapshot()
+        # Nothing queued is worth starting now
+        WORKER_POOL.clear()
+        event.accept()
+
 if __name__ == '__main__':
+    # The process pool spawns copies of this program (also when frozen by PyInstaller)
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
+    if LOCAL_CORPUS is not None:
+        LOCAL_CORPUS.start()
+    if WATCHDOG_ENABLED:
+        WATCHDOG = StallWatchdog()
+        WATCHDOG.start()
     window = MainWindow()
     window.show()
-    sys.exit(app.exec_())
+    QTimer.singleShot(0, warm_process_pool)
+    exit_code = app.exec_()
+    if WATCHDOG is not None:
+        WATCHDOG.stop()
+        print(WATCHDOG.summary())
+    # Cancelled workers stop at their next checkpoint; give them a moment before teardown
+    WORKER_POOL.waitForDone(SHUTDOWN_WAIT_MS)
+    sys.exit(exit_code)
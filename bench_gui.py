@@ -0,0 +1,245 @@
+"""
+Offscreen GUI benchmark for alvely's widgets.
+
+Builds transcripts, source lists and image grids of 10, 100 and 1000 items from
+synthetic data (no network, no API calls) and reports wall time and peak memory
+per case as JSON:
+
+    python bench_gui.py [--sizes 10,100,1000] [--repeat 3] [--output bench.json]
+
+Times come from runs without tracing; peak Python memory comes from a separate
+tracemalloc run, since tracing slows everything down. max_rss_kb is the process
+high-water mark after the case (Unix only) and includes Qt's own allocations.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+# Favicons are served from a throwaway asset cache seeded below
+os.environ.setdefault('ASSET_CACHE_DIR', tempfile.mkdtemp(prefix='alvely-bench-'))
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+os.environ.setdefault('ANTHROPIC_API_KEY', 'bench')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QBuffer, QByteArray, QEvent, QIODevice, QT_VERSION_STR
+from PyQt5.QtGui import QColor, QImage
+
+import alvely
+
+DOMAINS = 20
+ANSWER_PARAGRAPHS = 6
+
+
+def synthetic_answer(i):
+    lines = [f"## Answer {i}", ""]
+    for p in range(ANSWER_PARAGRAPHS):
+        lines.append(
+            f"Paragraph {p} of answer {i} covers **several** points with `inline code` and a "
+            f"[link](https://example{p % DOMAINS}.com/page/{i}). The needle is here in some answers."
+        )
+        lines.append("")
+    lines += ["- first item", "- second item", "", "```python", f"print({i})", "```"]
+    return "\n".join(lines)
+
+
+def synthetic_sources(n):
+    return [
+        {
+            'name': f"Result {i} about benchmarking Qt widgets",
+            'url': f"https://example{i % DOMAINS}.com/articles/{i}",
+            'snippet': f"Snippet {i}: a <b>short</b> description of the page, long enough to wrap once.",
+            'displayUrl': f"example{i % DOMAINS}.com/articles/{i}"
+        }
+        for i in range(n)
+    ]
+
+
+def synthetic_images(n, width=alvely.THUMBNAIL_WIDTH, height=200):
+    # Decoded the way fetch_thumbnail hands them to ImageWidget; a few distinct colours are reused
+    thumbnails = []
+    for c in range(8):
+        image = QImage(width, height, QImage.Format_RGBA8888)
+        image.fill(QColor.fromHsv(c * 45, 200, 200))
+        thumbnails.append((b'', image))
+    return [
+        {
+            'thumbnailUrl': f"https://thumbs.example.com/{i}.jpg",
+            'contentUrl': f"https://images.example.com/{i}.jpg",
+            'hostPageUrl': f"https://example{i % DOMAINS}.com/gallery/{i}",
+            'thumbnail': thumbnails[i % len(thumbnails)]
+        }
+        for i in range(n)
+    ]
+
+
+def seed_favicons():
+    image = QImage(16, 16, QImage.Format_RGBA8888)
+    image.fill(QColor('#55AAFF'))
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, 'PNG')
+    for d in range(DOMAINS):
+        fav_url = f"https://www.google.com/s2/favicons?sz=64&domain_url=example{d}.com"
+        alvely.ASSET_CACHE.store(fav_url, bytes(data), None, None, time.time() + 24 * 60 * 60)
+
+
+def settle(app):
+    # Let offloaded markdown renders land and deleteLater() run
+    while alvely.OFFLOAD_JOBS:
+        app.processEvents()
+        time.sleep(0.001)
+    app.sendPostedEvents(None, QEvent.DeferredDelete)
+    app.processEvents()
+
+
+def add_messages(tab, n):
+    for i in range(n):
+        if i % 2:
+            msg = alvely.MessageWidget('Assistant', synthetic_answer(i))
+        else:
+            msg = alvely.MessageWidget('User', f"Question {i} with a needle?")
+        tab.scroll_layout.addWidget(msg)
+
+
+def fill_transcript(tab, n):
+    add_messages(tab, n)
+    tab.displaySources(synthetic_sources(n))
+
+
+# Each case: (setup, timed); setup is not measured
+def case_messages(tab, n):
+    return None, lambda: add_messages(tab, n)
+
+
+def case_sources(tab, n):
+    return None, lambda: tab.displaySources(synthetic_sources(n))
+
+
+def case_images(tab, n):
+    images = synthetic_images(n)
+    tab.current_mode = 'image'
+    return None, lambda: tab.displayImages(images)
+
+
+def case_find(tab, n):
+    def setup():
+        add_messages(tab, n)
+        tab.showFindDialog()
+        tab.find_input.setText('needle')
+    return setup, tab.findNext
+
+
+def case_clear(tab, n):
+    return lambda: fill_transcript(tab, n), tab.clearResults
+
+
+def case_reload(tab, n):
+    return lambda: fill_transcript(tab, n), tab.reloadApp
+
+
+CASES = {
+    'messages': case_messages,
+    'sources': case_sources,
+    'images': case_images,
+    'find': case_find,
+    'clear': case_clear,
+    'reload': case_reload,
+}
+
+
+def run_case(app, name, n, trace):
+    tab = alvely.ChatApp()
+    tab.resize(1000, 800)
+    tab.show()
+    tab.stack.setCurrentWidget(tab.chat_page)
+    setup, timed = CASES[name](tab, n)
+    if setup:
+        setup()
+    settle(app)
+
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    timed()
+    settle(app)
+    seconds = time.perf_counter() - started
+    peak = None
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    tab.cancelWorkers()
+    tab.close()
+    tab.deleteLater()
+    settle(app)
+    return seconds, peak
+
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offscreen GUI benchmark for alvely")
+    parser.add_argument('--sizes', default='10,100,1000', help="comma-separated item counts")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per case; the best is reported")
+    parser.add_argument('--cases', default=','.join(CASES), help="comma-separated subset of " + ', '.join(CASES))
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    cases = [c for c in args.cases.split(',') if c]
+
+    app = QApplication(sys.argv)
+    results = []
+    # alvely logs to stdout; keep stdout for the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        seed_favicons()
+        alvely.warm_process_pool()
+        for name in cases:
+            for n in sizes:
+                times = [run_case(app, name, n, trace=False)[0] for _ in range(max(1, args.repeat))]
+                _, peak = run_case(app, name, n, trace=True)
+                results.append({
+                    'case': name,
+                    'items': n,
+                    'seconds': round(min(times), 4),
+                    'seconds_all': [round(t, 4) for t in times],
+                    'peak_python_kb': peak // 1024,
+                    'max_rss_kb': max_rss_kb()
+                })
+                print(f"[BENCH] {name} x{n}: {min(times) * 1000:.1f} ms, peak {peak // 1024} KB")
+
+    report = {
+        'python': platform.python_version(),
+        'qt': QT_VERSION_STR,
+        'platform': platform.platform(),
+        'results': results
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    alvely.WORKER_POOL.waitForDone(alvely.SHUTDOWN_WAIT_MS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test')
+
+import pytest
+
+import alvely
+
+MODEL = 'gpt-4o-mini'
+FINGERPRINT = 0x1234
+
+
+def cached(stored, asked, fingerprint=None):
+    cache = alvely.AnswerCache(16, 60, alvely.ANSWER_SIMILARITY)
+    cache.put(MODEL, (), stored, FINGERPRINT, 'answer', [], [])
+    return cache.get(MODEL, (), asked, fingerprint) is not None
+
+
+@pytest.mark.parametrize('stored, asked', [
+    ("what is the capital of france", "What is the capital of France?"),
+    ("convert celsius to fahrenheit", "convert celsius to fahrenheit?"),
+    ("what is the capital of france", "what's the capital of france"),
+    ('what does "select" do in sql', "what does select do in sql"),
+])
+def test_exact_after_normalization_before_search(stored, asked):
+    assert cached(stored, asked)
+
+
+@pytest.mark.parametrize('stored, asked', [
+    ("how to install numpy on windows", "how do i install numpy on windows"),
+    (
+        "what is the best way to install numpy on windows 11 using pip today",
+        "what is the best way to install numpy on windows 11 using pip now"
+    ),
+])
+def test_rephrasing_with_same_sources(stored, asked):
+    assert not cached(stored, asked)
+    assert cached(stored, asked, FINGERPRINT)
+
+
+@pytest.mark.parametrize('stored, asked', [
+    ("celsius to fahrenheit", "fahrenheit to celsius"),
+    ("python 2 install", "python 3 install"),
+    ("is it safe to delete this folder", "is it not safe to delete this folder"),
+    ("c++ vs rust", "c# vs rust"),
+])
+def test_different_questions_never_match(stored, asked):
+    assert not cached(stored, asked, FINGERPRINT)
+
+
+def test_rephrasing_with_other_sources():
+    assert not cached("how to install numpy on windows", "how do i install numpy on windows", FINGERPRINT + 1)